@@ -2,17 +2,28 @@
 """
 orchestrator.py - Orquestrador central da pipeline
 
-Executa todas as 7 etapas da geração de vídeos de forma sequencial
+Executa todas as etapas da geração de vídeos respeitando as dependências
+entre elas (etapas independentes rodam em paralelo)
 """
 
 import argparse
+import asyncio
+import collections
 import sys
-import subprocess
 import json
+import threading
+import time
+import traceback
+import importlib.util
 from pathlib import Path
 from datetime import datetime
 import logging
 
+try:
+    import orjson  # Serialização JSON nativa (opcional)
+except ImportError:
+    orjson = None
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -21,6 +32,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Scripts da pipeline (utils.py é usado para o aquecimento do Ollama)
+sys.path.insert(0, str(Path(__file__).parent / "scripts"))
+
+# Últimas linhas de saída de um step guardadas para o relatório de erro
+OUTPUT_TAIL_LINES = 200
+
+# Tamanho máximo de uma linha lida do processo filho (barras de progresso)
+STREAM_LIMIT = 1024 * 1024
+
 
 class VideoOrchestrator:
     """Coordena toda a pipeline de geração de vídeos"""
@@ -30,6 +50,7 @@ class VideoOrchestrator:
             "num": 1,
             "nome": "Planejamento",
             "script": "scripts/01_plan.py",
+            "fn": "create_plan",
             "icon": "📋",
             "descricao": "Planejamento do conteúdo"
         },
@@ -37,6 +58,7 @@ class VideoOrchestrator:
             "num": 2,
             "nome": "Roteiro",
             "script": "scripts/02_script.py",
+            "fn": "create_script",
             "icon": "📝",
             "descricao": "Criação do roteiro"
         },
@@ -44,6 +66,7 @@ class VideoOrchestrator:
             "num": 3,
             "nome": "Narração",
             "script": "scripts/03_voice.py",
+            "fn": "create_voice",
             "icon": "🎙️",
             "descricao": "Geração de narração (TTS)"
         },
@@ -51,6 +74,7 @@ class VideoOrchestrator:
             "num": 4,
             "nome": "Prompts",
             "script": "scripts/04_image_prompts.py",
+            "fn": "generate_image_prompts",
             "icon": "🎨",
             "descricao": "Geração de prompts para imagens"
         },
@@ -58,6 +82,7 @@ class VideoOrchestrator:
             "num": 5,
             "nome": "Imagens",
             "script": "scripts/05_generate_images_lowmem.py",
+            "fn": "generate_images_lowmem",
             "icon": "🖼️",
             "descricao": "Geração de imagens (Stable Diffusion)"
         },
@@ -65,13 +90,33 @@ class VideoOrchestrator:
             "num": 6,
             "nome": "Composição",
             "script": "scripts/07_compose_video.py",
+            "fn": "compose_video",
             "icon": "🎬",
             "descricao": "Composição do vídeo final"
         }
     ]
 
-    def __init__(self, topic: str, output_dir: str = None):
+    # Dependências entre steps (step -> steps que precisam terminar antes).
+    # O step 4 calcula o número de cenas a partir da duração de
+    # audio/narration.wav, por isso depende da narração (step 3).
+    DEPS = {
+        1: [],
+        2: [1],
+        3: [2],
+        4: [2, 3],
+        5: [4],
+        6: [3, 5]
+    }
+
+    # Steps que usam o Ollama (mistral)
+    OLLAMA_STEPS = {1, 2, 4}
+
+    def __init__(self, topic: str, output_dir: str = None, fast_mode: bool = False,
+                 use_subprocess: bool = False, turbo: bool = False):
         self.topic = topic
+        self.fast_mode = fast_mode
+        self.turbo = turbo
+        self.use_subprocess = use_subprocess
         self.start_time = datetime.now()
 
         # Criar diretório de saída
@@ -83,62 +128,195 @@ class VideoOrchestrator:
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
         self.log_file = self.output_dir / "pipeline.log"
+        self._log_fh = open(self.log_file, "a", buffering=1, encoding="utf-8")
         self.results = {
             "tema": topic,
             "inicio": self.start_time.isoformat(),
             "etapas": {}
         }
 
+        # Módulos dos steps já importados (modo in-process)
+        self._modules = {}
+
+        # Artefatos produzidos pelos steps (plan, script, image_prompts),
+        # repassados em memória para os steps seguintes
+        self.state = {}
+
+        # Chamada de cada step, com argumentos definidos uma única vez
+        self._step_fns = self._build_step_fns()
+
     def log(self, message: str):
         """Registra mensagem em log"""
         logger.info(message)
-        with open(self.log_file, "a") as f:
-            f.write(f"[{datetime.now().strftime('%H:%M:%S')}] {message}\n")
+        self._log_fh.write(f"[{time.strftime('%H:%M:%S')}] {message}\n")
+
+    def close(self):
+        """Fecha o arquivo de log"""
+        self._log_fh.close()
+
+    def _warmup_ollama(self):
+        """Carrega o modelo do Ollama enquanto a pipeline inicia"""
+        try:
+            from utils import get_ollama_client
+            get_ollama_client().warmup("mistral", keep_alive="10m")
+            logger.info("🔥 Modelo do Ollama carregado")
+        except Exception as e:
+            logger.warning(f"⚠️  Não foi possível pré-carregar o Ollama: {e}")
+
+    def load_state(self):
+        """Recarrega do disco os artefatos de uma execução anterior"""
+        artifacts = {
+            "plan": "plan.json",
+            "script": "script.md",
+            "image_prompts": "image_prompts.json"
+        }
+
+        for key, filename in artifacts.items():
+            filepath = self.output_dir / filename
+            if not filepath.exists():
+                continue
+
+            with open(filepath, 'r', encoding='utf-8') as f:
+                if filepath.suffix == ".json":
+                    self.state[key] = json.load(f)
+                else:
+                    self.state[key] = f.read()
+
+            logger.info(f"♻️  Retomando {filename}")
+
+    def _load_module(self, script_path: str):
+        """Importa o script de um step (uma única vez por pipeline)"""
+        if script_path not in self._modules:
+            path = Path(script_path)
+            spec = importlib.util.spec_from_file_location(path.stem, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self._modules[script_path] = module
+        return self._modules[script_path]
+
+    def _build_step_fns(self) -> dict:
+        """Monta uma chamada por step com os argumentos já fixados
+
+        Cada entrada é uma função sem argumentos que retorna a coroutine do
+        step; execute_pipeline só precisa chamá-la.
+        """
+        output_dir = str(self.output_dir)
+        steps = {step["num"]: step for step in self.STEPS}
+        image_argv = (["--turbo"] if self.turbo else []) + (["--fast"] if self.fast_mode else [])
+
+        # step -> (args da função, kwargs da função, argumentos de linha de comando)
+        calls = {
+            1: ((self.topic, output_dir), {"state": self.state},
+                ["--topic", self.topic, "--output", output_dir]),
+            2: (("plan.json", output_dir), {"state": self.state}, ["--output", output_dir]),
+            3: (("script.md", output_dir), {"state": self.state}, ["--output", output_dir]),
+            4: (("script.md", output_dir), {"state": self.state}, ["--output", output_dir]),
+            5: (("image_prompts.json", output_dir),
+                {"state": self.state, "turbo": self.turbo, "fast": self.fast_mode},
+                ["--output", output_dir, *image_argv]),
+            6: ((output_dir,), {}, ["--project", output_dir])
+        }
+
+        def make_fn(step, args, kwargs, argv):
+            if self.use_subprocess:
+                return lambda: self._run_subprocess(step, argv)
+            return lambda: asyncio.to_thread(self._run_inprocess, step, args, kwargs)
+
+        return {
+            num: make_fn(steps[num], *call)
+            for num, call in calls.items()
+        }
+
+    def _run_inprocess(self, step: dict, args: tuple, kwargs: dict) -> bool:
+        """Executa a função do step no próprio processo"""
+
+        step_num = step["num"]
+
+        logger.info(f"\n>>> {Path(step['script']).stem}.{step['fn']}()\n")
+
+        try:
+            module = self._load_module(step["script"])
+            getattr(module, step["fn"])(*args, **kwargs)
+            return True
+        except SystemExit as e:
+            # Scripts encerram com sys.exit() quando faltam dependências
+            if e.code in (0, None):
+                return True
+            self.log(f"✗ Erro no step {step_num}: script encerrado (código {e.code})")
+            return False
+        except Exception as e:
+            # Traceback completo no console, no pipeline.log e no jsonl
+            # (o modo --subprocess mostra o mesmo pelo final do stderr)
+            trace = traceback.format_exc()
+            self.log(f"✗ Erro no step {step_num}: {e}")
+            self._log_fh.write(trace)
+            logger.error(trace.rstrip())
+            self.results["etapas"][step_num] = {
+                "nome": step["nome"],
+                "status": "erro",
+                "erro": str(e),
+                "traceback": trace,
+                "timestamp": datetime.now().isoformat()
+            }
+            self.append_step_result(step_num)
+            return False
+
+    async def _run_subprocess(self, step: dict, argv: list) -> bool:
+        """Executa o script do step em um processo Python separado"""
+
+        step_num = step["num"]
+        cmd = ["python3", step["script"], *argv]
+
+        # Executar script
+        logger.info(f"\n$ python3 {' '.join(cmd[1:])}\n")
+
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            limit=STREAM_LIMIT
+        )
+
+        # Repassar a saída linha a linha (sem acumular tudo em memória)
+        tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
 
-    def run_step(self, step: dict) -> bool:
+        async def stream_output():
+            async for raw_line in proc.stdout:
+                line = raw_line.decode("utf-8", errors="replace").rstrip()
+                tail.append(line)
+                logger.info(line)
+                self._log_fh.write(line + "\n")
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(stream_output(), proc.wait()),
+                timeout=3600  # 1 hora por step
+            )
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise
+
+        if proc.returncode != 0:
+            output_tail = "\n".join(tail)
+            self.log(f"✗ Erro no step {step_num}: {output_tail}")
+            logger.error(output_tail)
+            return False
+
+        return True
+
+    async def run_step(self, step: dict) -> bool:
         """Executa um step da pipeline"""
 
         step_num = step["num"]
         step_icon = step["icon"]
         step_nome = step["nome"]
-        script_path = step["script"]
 
         self.log(f"\n{step_icon} ETAPA {step_num}/7: {step_nome}")
         self.log(f"{'=' * 50}")
 
         try:
-            # Construir comando
-            cmd = [
-                "python3",
-                script_path
-            ]
-            
-            # Argumentos específicos por step
-            if step_num == 7:  # Composição de vídeo usa --project
-                cmd.extend(["--project", str(self.output_dir)])
-            else:  # Outros steps usam --output
-                cmd.extend(["--output", str(self.output_dir)])
-
-            if step_num == 1:  # Planejamento
-                cmd.extend(["--topic", self.topic])
-
-            elif step_num == 5:  # Imagens - permitir modo rápido
-                if hasattr(self, 'fast_mode') and self.fast_mode:
-                    cmd.append("--fast")
-
-            # Executar script
-            logger.info(f"\n$ python3 {' '.join(cmd[1:])}\n")
-
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=3600  # 1 hora por step
-            )
-
-            if result.returncode != 0:
-                self.log(f"✗ Erro no step {step_num}: {result.stderr}")
-                logger.error(result.stderr)
+            if not await self._step_fns[step_num]():
                 return False
 
             # Registrar sucesso
@@ -148,17 +326,18 @@ class VideoOrchestrator:
                 "status": "sucesso",
                 "timestamp": datetime.now().isoformat()
             }
+            self.append_step_result(step_num)
 
             return True
 
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             self.log(f"✗ Timeout no step {step_num} (limite 1 hora)")
             return False
         except Exception as e:
             self.log(f"✗ Erro no step {step_num}: {e}")
             return False
 
-    def execute_pipeline(self, skip_steps: list = None) -> bool:
+    async def execute_pipeline(self, skip_steps: list = None) -> bool:
         """Executa pipeline completa"""
 
         skip_steps = skip_steps or []
@@ -174,20 +353,41 @@ class VideoOrchestrator:
         self.log(f"Tema: {self.topic}")
         self.log(f"Diretório: {self.output_dir}")
 
-        # Executar steps
-        for step in self.STEPS:
+        # Pré-carregar o modelo em paralelo (esconde o tempo de load na VRAM)
+        if self.OLLAMA_STEPS - set(skip_steps):
+            threading.Thread(target=self._warmup_ollama, daemon=True).start()
+
+        # Executar steps (cada um aguarda apenas as suas dependências)
+        tasks = {}
+        failed = []
+
+        async def run_when_ready(step: dict) -> bool:
             step_num = step["num"]
+            deps = [tasks[dep] for dep in self.DEPS.get(step_num, [])]
+            if not all(await asyncio.gather(*deps)):
+                return False
 
             if step_num in skip_steps:
                 logger.info(f"⏭️  Step {step_num} pulado")
-                continue
+                return True
 
-            if not self.run_step(step):
-                logger.error(f"\n❌ Pipeline interrompida no step {step_num}")
-                self.log(f"Pipeline interrompida no step {step_num}")
-                self.results["status"] = "erro"
-                self.save_results()
+            if not await self.run_step(step):
+                failed.append(step_num)
                 return False
+            return True
+
+        for step in self.STEPS:
+            tasks[step["num"]] = asyncio.create_task(run_when_ready(step))
+
+        await asyncio.gather(*tasks.values())
+
+        if failed:
+            step_num = failed[0]
+            logger.error(f"\n❌ Pipeline interrompida no step {step_num}")
+            self.log(f"Pipeline interrompida no step {step_num}")
+            self.results["status"] = "erro"
+            self.save_results()
+            return False
 
         # Sucesso!
         end_time = datetime.now()
@@ -211,9 +411,29 @@ class VideoOrchestrator:
 
         return True
 
+    def append_step_result(self, step_num: int):
+        """Acrescenta o resultado de um step em pipeline_results.jsonl"""
+        record = {"etapa": step_num, **self.results["etapas"][step_num]}
+
+        if orjson is not None:
+            line = orjson.dumps(record)
+        else:
+            line = json.dumps(record, ensure_ascii=False).encode("utf-8")
+
+        with open(self.output_dir / "pipeline_results.jsonl", "ab") as f:
+            f.write(line + b"\n")
+
     def save_results(self):
-        """Salva resultados em JSON"""
+        """Salva resumo final dos resultados em JSON"""
         results_file = self.output_dir / "pipeline_results.json"
+
+        if orjson is not None:
+            results_file.write_bytes(orjson.dumps(
+                self.results,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+            ))
+            return
+
         with open(results_file, 'w') as f:
             json.dump(self.results, f, indent=2, ensure_ascii=False)
 
@@ -234,7 +454,12 @@ def main():
     parser.add_argument(
         "--fast",
         action="store_true",
-        help="Modo rápido (menos steps em geração de imagens)"
+        help="Modo rápido (menos steps em geração de imagens; ignorado com --turbo)"
+    )
+    parser.add_argument(
+        "--turbo",
+        action="store_true",
+        help="Imagens com LCM-LoRA (4 steps, bem mais rápido)"
     )
     parser.add_argument(
         "--skip",
@@ -243,14 +468,35 @@ def main():
         default=[],
         help="Steps para pular (números 1-7)"
     )
+    parser.add_argument(
+        "--subprocess",
+        action="store_true",
+        help="Executa cada step em um processo Python separado (modo antigo)"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Recarrega plan.json/script.md/image_prompts.json do diretório de saída"
+    )
 
     args = parser.parse_args()
 
     # Criar e executar orquestrador
-    orchestrator = VideoOrchestrator(args.topic, args.output)
-    orchestrator.fast_mode = args.fast
+    orchestrator = VideoOrchestrator(
+        args.topic,
+        args.output,
+        fast_mode=args.fast,
+        use_subprocess=args.subprocess,
+        turbo=args.turbo
+    )
+
+    if args.resume:
+        orchestrator.load_state()
 
-    success = orchestrator.execute_pipeline(skip_steps=args.skip)
+    try:
+        success = asyncio.run(orchestrator.execute_pipeline(skip_steps=args.skip))
+    finally:
+        orchestrator.close()
     sys.exit(0 if success else 1)
 
 
@@ -13,7 +13,7 @@ from pathlib import Path
 # Adiciona diretório de scripts ao path
 sys.path.insert(0, str(Path(__file__).parent))
 
-from utils import OllamaClient, FileManager, ConfigManager, logger
+from utils import get_ollama_client, FileManager, ConfigManager, Plan, logger
 
 
 PLAN_PROMPT = """Você é um especialista em criação de conteúdo para YouTube Shorts.
@@ -36,13 +36,15 @@ Estruture um plano para vídeo curto (60 segundos) com as seguintes informaçõe
 Seja direto. Retorne APENAS JSON válido, sem explicações."""
 
 
-def create_plan(topic: str, output_dir: str):
+def create_plan(topic: str, output_dir: str, state: dict = None):
     """Cria plano do vídeo usando Ollama"""
 
+    state = state if state is not None else {}
+
     logger.info(f"📋 Planejamento: {topic}")
 
     # Inicializar clients
-    ollama = OllamaClient()
+    ollama = get_ollama_client()
     files = FileManager(output_dir)
 
     try:
@@ -50,25 +52,22 @@ def create_plan(topic: str, output_dir: str):
         prompt = PLAN_PROMPT.format(topic=topic)
         logger.info("⏳ Gerando plano com Ollama...")
 
-        plan = ollama.generate_json(prompt, model="mistral")
+        response = ollama.generate_json(prompt, model="mistral")
 
-        # Validar estrutura básica
-        required_fields = ["tema", "publico", "tom", "pontos_chave"]
-        for field in required_fields:
-            if field not in plan:
-                logger.error(f"Campo obrigatório faltando: {field}")
-                raise ValueError(f"Resposta inválida do Ollama: falta {field}")
+        # Validar estrutura (campos obrigatórios e tipos)
+        plan = Plan.from_dict(response).to_dict()
 
         # Salvar plano
         files.save_json("plan.json", plan)
+        state["plan"] = plan
 
         # Exibir resumo
         logger.info(f"✓ Plano criado com sucesso!")
         logger.info(f"  Tema: {plan['tema']}")
         logger.info(f"  Público: {plan['publico']}")
         logger.info(f"  Tom: {plan['tom']}")
-        logger.info(f"  Cenas: {plan.get('num_cenas', 5)}")
-        logger.info(f"  Hook: {plan.get('hook_inicial', 'N/A')}")
+        logger.info(f"  Cenas: {plan['num_cenas']}")
+        logger.info(f"  Hook: {plan['hook_inicial'] or 'N/A'}")
 
         return plan
 
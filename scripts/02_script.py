@@ -12,7 +12,7 @@ from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent))
 
-from utils import OllamaClient, FileManager, logger
+from utils import get_ollama_client, FileManager, Plan, logger
 
 
 SCRIPT_PROMPT = """Você é um roteirista especializado em conteúdo educativo para redes sociais.
@@ -51,17 +51,19 @@ Use este formato para cada cena:
 Seja detalhado na narração. Mantenha o tom especificado. Maximize o impacto educativo e visual."""
 
 
-def create_script(plan_file: str, output_dir: str):
+def create_script(plan_file: str, output_dir: str, state: dict = None):
     """Cria script do vídeo baseado no plano"""
 
+    state = state if state is not None else {}
+
     logger.info("📝 Geração de roteiro")
 
     files = FileManager(output_dir)
-    ollama = OllamaClient()
+    ollama = get_ollama_client()
 
     try:
-        # Carregar plano
-        plan = files.load_json("plan.json")
+        # Carregar plano (do step anterior, se disponível)
+        plan = Plan.from_dict(state.get("plan") or files.load_json("plan.json")).to_dict()
 
         # Gerar script com Ollama
         prompt = SCRIPT_PROMPT.format(
@@ -69,7 +71,7 @@ def create_script(plan_file: str, output_dir: str):
             publico=plan["publico"],
             tom=plan["tom"],
             pontos_chave=", ".join(plan["pontos_chave"]),
-            num_cenas=plan.get("num_cenas", 5)
+            num_cenas=plan["num_cenas"]
         )
 
         logger.info("⏳ Gerando script com Ollama...")
@@ -77,6 +79,8 @@ def create_script(plan_file: str, output_dir: str):
 
         # Salvar script
         files.save_text("script.md", script)
+        state["script"] = script
+        state.pop("scenes", None)  # Cenas parseadas do roteiro anterior
 
         # Contar cenas
         num_scenes = script.count("## CENA")
@@ -9,101 +9,90 @@ Output: narration.wav + timestamps.json
 import argparse
 import sys
 import os
-import re
+import shutil
 import subprocess
 import json
-import tempfile
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent))
 
-from utils import FileManager, ScriptParser, TimestampExtractor, logger
+from utils import FileManager, ScriptParser, TimestampExtractor, extract_narration_text, logger
 
 
-def extract_narration_text(script_content: str) -> str:
-    """Extrai apenas o texto de narração do script"""
+# Locais de instalação do Piper verificados quando ele não está no PATH
+PIPER_PATHS = [
+    "/home/valente/.local/bin/piper",  # Instalação local
+    "/usr/local/bin/piper",  # Instalação global
+    "/usr/bin/piper"  # Instalação do sistema
+]
 
-    lines = script_content.split('\n')
-    narration_lines = []
+# Diretório dos modelos de voz baixados pelo setup (resolvido uma única vez)
+PIPER_MODELS_DIR = os.path.expanduser("~/.local/share/piper")
 
-    for line in lines:
-        if line.startswith('**Narração:**'):
-            text = line.replace('**Narração:**', '').strip()
-            narration_lines.append(text)
+# Executável do Piper já localizado (evita repetir a busca)
+_piper_cmd = None
 
-    return ' '.join(narration_lines)
+
+def find_piper() -> str:
+    """Localiza o executável do Piper sem executar nenhum processo"""
+    global _piper_cmd
+
+    if _piper_cmd is None:
+        _piper_cmd = shutil.which("piper") or next(
+            (path for path in PIPER_PATHS if os.path.isfile(path) and os.access(path, os.X_OK)),
+            None
+        )
+        if _piper_cmd:
+            logger.info(f"Piper encontrado em: {_piper_cmd}")
+
+    return _piper_cmd
 
 
 def generate_voice(narration_text: str, output_file: str, language: str = "pt_BR", model: str = "faber-medium"):
     """Gera áudio usando Piper TTS"""
 
-    # Tentar encontrar o executável piper
-    piper_cmd = None
-    possible_paths = [
-        "piper",  # Se estiver no PATH
-        "/home/valente/.local/bin/piper",  # Instalação local
-        "/usr/local/bin/piper",  # Instalação global
-        "/usr/bin/piper"  # Instalação do sistema
-    ]
-    
-    for piper_path in possible_paths:
-        try:
-            result = subprocess.run(
-                [piper_path, "--help"],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            if result.returncode == 0:
-                piper_cmd = piper_path
-                logger.info(f"Piper encontrado em: {piper_path}")
-                break
-        except (FileNotFoundError, subprocess.TimeoutExpired):
-            continue
-    
+    # Encontrar o executável piper
+    piper_cmd = find_piper()
+
     if not piper_cmd:
         logger.error("Piper TTS não foi encontrado!")
         logger.error("Execute: pip install piper-tts")
         logger.error("E certifique-se de que ~/.local/bin está no PATH")
         raise RuntimeError("Piper TTS não encontrado")
 
+    # Caminho completo para o modelo
+    model_path = os.path.join(PIPER_MODELS_DIR, f"{language}-{model}.onnx")
+
+    if not os.path.isfile(model_path):
+        logger.error(f"Modelo não encontrado: {model_path}")
+        logger.error("Execute o setup para baixar os modelos de voz")
+        raise RuntimeError(f"Modelo {language}-{model} não encontrado")
+
     try:
-        # Criar arquivo temporário com o texto
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8') as tmp:
-            tmp.write(narration_text)
-            tmp_path = tmp.name
-
-        try:
-            # Executar Piper
-            logger.info(f"⏳ Gerando áudio com Piper ({language}-{model})...")
-            
-            # Caminho completo para o modelo
-            model_path = os.path.expanduser(f"~/.local/share/piper/{language}-{model}.onnx")
-            
-            if not os.path.exists(model_path):
-                logger.error(f"Modelo não encontrado: {model_path}")
-                logger.error("Execute o setup para baixar os modelos de voz")
-                raise RuntimeError(f"Modelo {language}-{model} não encontrado")
-
-            cmd = [
-                piper_cmd,
-                "--model", model_path,
-                "--input_file", tmp_path,
-                "--output_file", output_file,
-                "--speaker", "0"
-            ]
-
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-
-            if result.returncode != 0:
-                logger.error(f"Erro do Piper: {result.stderr}")
-                raise RuntimeError(f"Piper falhou: {result.stderr}")
-
-            logger.info(f"✓ Áudio gerado: {output_file}")
-
-        finally:
-            # Limpar arquivo temporário
-            Path(tmp_path).unlink(missing_ok=True)
+        # Executar Piper
+        logger.info(f"⏳ Gerando áudio com Piper ({language}-{model})...")
+
+        cmd = [
+            piper_cmd,
+            "--model", model_path,
+            "--output_file", output_file,
+            "--speaker", "0"
+        ]
+
+        # Texto enviado direto pelo stdin (sem arquivo temporário)
+        result = subprocess.run(
+            cmd,
+            input=narration_text,
+            capture_output=True,
+            text=True,
+            timeout=300
+        )
+
+        if result.returncode != 0:
+            logger.error(f"Erro do Piper: {result.stderr}")
+            raise RuntimeError(f"Piper falhou: {result.stderr}")
+
+        logger.info(f"✓ Áudio gerado: {output_file}")
 
     except subprocess.TimeoutExpired:
         logger.error("Timeout ao gerar áudio (limite de 5 minutos)")
@@ -113,45 +102,21 @@ def generate_voice(narration_text: str, output_file: str, language: str = "pt_BR
         raise
 
 
-def extract_scene_timing(script_content: str) -> list[dict]:
-    """Extrai timing de cada cena do script"""
-
-    scenes_data = []
-    lines = script_content.split('\n')
-
-    current_scene = None
-
-    for line in lines:
-        # Detectar cabeçalho de cena (## CENA X (Y-Zs))
-        match = re.search(r'## CENA (\d+) \((\d+)-(\d+)s\)', line)
-        if match:
-            current_scene = {
-                "numero": int(match.group(1)),
-                "start": int(match.group(2)),
-                "end": int(match.group(3)),
-                "naracao": ""
-            }
-            scenes_data.append(current_scene)
-
-        # Extrair narração
-        if line.startswith('**Narração:**') and current_scene:
-            current_scene["naracao"] = line.replace('**Narração:**', '').strip()
-
-    return scenes_data
-
-
-def create_voice(script_path: str, output_dir: str, language: str = "pt_BR"):
+def create_voice(script_path: str, output_dir: str, language: str = "pt_BR", state: dict = None):
     """Cria narração baseada no script"""
 
+    state = state if state is not None else {}
+
     logger.info("🎙️  Geração de narração")
 
     files = FileManager(output_dir)
 
     try:
-        # Carregar script
-        script_content = files.load_text("script.md")
+        # Carregar script (do step anterior, se disponível)
+        script_content = state.get("script") or files.load_text("script.md")
+        state["script"] = script_content
 
-        # Extrair texto de narração
+        # Extrair texto de narração (inclui linhas fora de um cabeçalho de cena)
         logger.info("📄 Extraindo narração...")
         narration_text = extract_narration_text(script_content)
 
@@ -163,8 +128,9 @@ def create_voice(script_path: str, output_dir: str, language: str = "pt_BR"):
         audio_output = str(files.get_audio_path())
         generate_voice(narration_text, audio_output, language=language)
 
-        # Extrair timing de cenas
-        scenes_timing = extract_scene_timing(script_content)
+        # Extrair timing de cenas (compartilhado com o step de prompts)
+        scenes_timing = state.get("scenes") or ScriptParser.parse_script(script_content)
+        state["scenes"] = scenes_timing
 
         # Extrair informações de áudio
         audio_info = TimestampExtractor.extract_from_audio(audio_output)
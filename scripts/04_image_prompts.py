@@ -7,15 +7,26 @@ Output: image_prompts.json com prompts otimizados (quantidade baseada na duraç
 """
 
 import argparse
-import sys
-import re
+import asyncio
+import hashlib
 import json
+import os
+import sys
 import subprocess
+import tempfile
+import wave
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional
 
 sys.path.insert(0, str(Path(__file__).parent))
 
-from utils import OllamaClient, FileManager, ScriptParser, logger
+from utils import OllamaClient, get_ollama_client, FileManager, Plan, ScriptParser, logger
+
+try:
+    from ollama import AsyncClient
+except ImportError:
+    AsyncClient = None  # Sem o pacote ollama: requisições HTTP em threads
 
 
 PROMPT_OPTIMIZER = """Você é especialista em prompts para Stable Diffusion.
@@ -33,9 +44,50 @@ Gere um prompt otimizado para geração de imagem 4K seguindo estas diretrizes:
 
 Retorne APENAS o prompt otimizado, sem explicações ou aspas."""
 
+# Modelo e temperatura usados na otimização dos prompts
+OPTIMIZER_MODEL = "mistral"
+OPTIMIZER_TEMPERATURE = 0.5
+
+# Prompts de SD têm < 100 tokens: limitar a decodificação corta a latência por chamada
+OPTIMIZER_OPTIONS = {"num_predict": 120}
+
+
+def _ollama_concurrency(default: int = 4) -> int:
+    """Lê OLLAMA_NUM_PARALLEL (valor inválido: padrão; nunca menos que 1)"""
+    value = os.environ.get("OLLAMA_NUM_PARALLEL", "")
+    try:
+        return max(1, int(value))
+    except ValueError:
+        if value:
+            logger.warning(f"OLLAMA_NUM_PARALLEL inválido: {value!r}, usando {default}")
+        return default
+
+
+# Máximo de requisições simultâneas ao Ollama (acompanha OLLAMA_NUM_PARALLEL do servidor)
+OLLAMA_CONCURRENCY = _ollama_concurrency()
+
+# Cenas por duração: (até N segundos, 1 imagem a cada X segundos, mínimo de cenas)
+SCENE_TIERS = (
+    (30, 15, 2),             # Mínimo 2 imagens
+    (60, 15, 3),
+    (120, 12, 5),
+    (float("inf"), 10, 8),   # Máximo detalhamento para vídeos longos
+)
+
+# Cache dos prompts otimizados (reaproveitado ao re-executar a pipeline)
+PROMPT_CACHE_DIR = Path(
+    os.environ.get("VIDGEN_PROMPT_CACHE", Path.home() / ".cache" / "vidgen" / "prompts")
+)
+
 
 def get_audio_duration(audio_file: Path) -> float:
-    """Obtém duração do áudio em segundos"""
+    """Obtém duração do áudio em segundos (cabeçalho WAV; ffprobe para outros formatos)"""
+    try:
+        with wave.open(str(audio_file), 'rb') as w:
+            return w.getnframes() / float(w.getframerate())
+    except (wave.Error, EOFError):
+        pass
+
     try:
         result = subprocess.run([
             "ffprobe", "-i", str(audio_file), 
@@ -50,21 +102,19 @@ def get_audio_duration(audio_file: Path) -> float:
 
 def calculate_optimal_scenes(audio_duration: float) -> int:
     """Calcula quantidade ideal de cenas baseado na duração"""
-    # 1 imagem a cada 12-15 segundos
-    if audio_duration <= 30:
-        return 2  # Mínimo 2 imagens
-    elif audio_duration <= 60:
-        return max(3, int(audio_duration / 15))
-    elif audio_duration <= 120:
-        return max(5, int(audio_duration / 12))
-    else:
-        return max(8, int(audio_duration / 10))  # Máximo detalhamento para vídeos longos
+    for threshold, seconds_per_scene, minimum in SCENE_TIERS:
+        if audio_duration <= threshold:
+            return max(minimum, int(audio_duration / seconds_per_scene))
 
 
 def redistribute_scenes(original_scenes: list, target_count: int, audio_duration: float) -> list:
-    """Redistribui cenas para atingir quantidade ideal"""
+    """Redistribui cenas para atingir quantidade ideal (sempre com 'duracao')"""
     if len(original_scenes) == target_count:
-        return original_scenes
+        # Cópias: as cenas originais são compartilhadas com os outros steps
+        return [
+            {**scene, "duracao": scene["end"] - scene["start"]}
+            for scene in original_scenes
+        ]
     
     time_per_scene = audio_duration / target_count
     new_scenes = []
@@ -89,44 +139,126 @@ def redistribute_scenes(original_scenes: list, target_count: int, audio_duration
     return new_scenes
 
 
-def extract_visuals_from_script(script_content: str) -> list[dict]:
-    """Extrai descrições visuais do script"""
+def prompt_cache_path(visual: str, context: str, model: str, temperature: float) -> Path:
+    """Retorna o arquivo de cache de um prompt otimizado
 
-    visuals = []
-    lines = script_content.split('\n')
+    A chave inclui o template e as opções do Ollama: mudar qualquer um deles
+    invalida o cache sem precisar limpar VIDGEN_PROMPT_CACHE.
+    """
+    key = "\0".join([
+        visual, context, model, str(temperature),
+        json.dumps(OPTIMIZER_OPTIONS, sort_keys=True), PROMPT_OPTIMIZER
+    ])
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+    return PROMPT_CACHE_DIR / f"{digest}.txt"
 
-    current_scene = None
 
-    for line in lines:
-        # Detectar cabeçalho de cena
-        match = re.search(r'## CENA (\d+) \((\d+)-(\d+)s\)', line)
-        if match:
-            current_scene = {
-                "numero": int(match.group(1)),
-                "timing": f"{match.group(2)}-{match.group(3)}s",
-                "naracao": "",
-                "visual": ""
-            }
-            visuals.append(current_scene)
+def save_cached_prompt(cache_path: Path, prompt: str):
+    """Grava prompt no cache de forma atômica"""
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(prompt)
+    os.replace(tmp_path, cache_path)
 
-        # Extrair narração
-        if line.startswith('**Narração:**') and current_scene:
-            current_scene["naracao"] = line.replace('**Narração:**', '').strip()
 
-        # Extrair visual
-        if line.startswith('**Visual:**') and current_scene:
-            current_scene["visual"] = line.replace('**Visual:**', '').strip()
+def build_optimizer_prompt(scene: dict, context: str) -> str:
+    """Monta o prompt de otimização de uma cena"""
+    return PROMPT_OPTIMIZER.format(
+        visual_description=scene['visual'],
+        context=context
+    )
 
-    return visuals
 
+def load_cached_prompt(scene: dict, context: str, use_cache: bool = True) -> tuple[Path, Optional[str]]:
+    """Retorna o arquivo de cache da cena e o prompt já otimizado (se houver)"""
+    cache_path = prompt_cache_path(
+        scene['visual'], context, OPTIMIZER_MODEL, OPTIMIZER_TEMPERATURE
+    )
+    if use_cache and cache_path.exists():
+        return cache_path, cache_path.read_text(encoding='utf-8')
+    return cache_path, None
+
+
+def optimize_prompt(ollama: OllamaClient, scene: dict, context: str, use_cache: bool = True) -> str:
+    """Otimiza o prompt de uma única cena (síncrono)"""
+    cache_path, cached = load_cached_prompt(scene, context, use_cache)
+    if cached is not None:
+        logger.info(f"  Cena {scene['numero']} (cache)")
+        return cached
+
+    logger.info(f"  Cena {scene['numero']}...")
+    optimized = ollama.generate(
+        build_optimizer_prompt(scene, context),
+        model=OPTIMIZER_MODEL,
+        temperature=OPTIMIZER_TEMPERATURE,
+        options=OPTIMIZER_OPTIONS
+    )
+    save_cached_prompt(cache_path, optimized)
+    return optimized
+
+
+async def _optimize_one(ollama_async, scene: dict, context: str) -> str:
+    """Otimiza o prompt de uma cena com o AsyncClient do Ollama"""
+    try:
+        response = await ollama_async.generate(
+            model=OPTIMIZER_MODEL,
+            prompt=build_optimizer_prompt(scene, context),
+            options={"temperature": OPTIMIZER_TEMPERATURE, **OPTIMIZER_OPTIONS}
+        )
+        return response["response"].strip()
+    except Exception as e:
+        logger.error(f"Erro ao gerar com Ollama: {e}")
+        raise
 
-def generate_image_prompts(script_path: str, output_dir: str):
-    """Gera prompts otimizados para cada cena baseado na duração do áudio"""
+
+async def optimize_prompts(ollama: OllamaClient, scenes: list, context: str, use_cache: bool = True) -> list[str]:
+    """Otimiza os prompts de todas as cenas em paralelo (mantém a ordem)"""
+
+    semaphore = asyncio.Semaphore(OLLAMA_CONCURRENCY)
+    ollama_async = AsyncClient(host=ollama.base_url) if AsyncClient else None
+
+    async def optimize(scene: dict) -> str:
+        cache_path, cached = load_cached_prompt(scene, context, use_cache)
+        if cached is not None:
+            logger.info(f"  Cena {scene['numero']}/{len(scenes)} (cache)")
+            return cached
+
+        async with semaphore:
+            logger.info(f"  Cena {scene['numero']}/{len(scenes)}...")
+            if ollama_async is not None:
+                optimized = await _optimize_one(ollama_async, scene, context)
+            else:
+                optimized = await ollama.generate_async(
+                    build_optimizer_prompt(scene, context),
+                    model=OPTIMIZER_MODEL,
+                    temperature=OPTIMIZER_TEMPERATURE,
+                    options=OPTIMIZER_OPTIONS
+                )
+
+        save_cached_prompt(cache_path, optimized)
+        return optimized
+
+    try:
+        return await asyncio.gather(*(optimize(scene) for scene in scenes))
+    finally:
+        # Fecha o pool httpx do AsyncClient (o loop termina com o asyncio.run)
+        if ollama_async is not None:
+            await ollama_async._client.aclose()
+
+
+def generate_image_prompts(script_path: str, output_dir: str, state: dict = None, use_cache: bool = True):
+    """Gera prompts otimizados para cada cena baseado na duração do áudio
+
+    use_cache=False ignora os prompts em cache (e os substitui pelos novos).
+    """
+
+    state = state if state is not None else {}
 
     logger.info("🎨 Geração de prompts para imagens")
 
     files = FileManager(output_dir)
-    ollama = OllamaClient()
+    ollama = get_ollama_client()
 
     try:
         # Verificar se áudio existe
@@ -135,20 +267,27 @@ def generate_image_prompts(script_path: str, output_dir: str):
             logger.error(f"Áudio não encontrado: {audio_file}")
             raise FileNotFoundError("Execute primeiro o step de narração!")
 
-        # Obter duração do áudio
-        audio_duration = get_audio_duration(audio_file)
-        optimal_scenes = calculate_optimal_scenes(audio_duration)
-        
-        logger.info(f"🎬 Duração do áudio: {audio_duration:.1f}s")
-        logger.info(f"📊 Cenas ideais: {optimal_scenes}")
+        # Carregar script e plano (dos steps anteriores, se disponíveis) em paralelo
+        # com a leitura da duração do áudio
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            script_future = pool.submit(lambda: state.get("script") or files.load_text("script.md"))
+            plan_future = pool.submit(lambda: state.get("plan") or files.load_json("plan.json"))
+
+            # Obter duração do áudio
+            audio_duration = get_audio_duration(audio_file)
+            optimal_scenes = calculate_optimal_scenes(audio_duration)
+            
+            logger.info(f"🎬 Duração do áudio: {audio_duration:.1f}s")
+            logger.info(f"📊 Cenas ideais: {optimal_scenes}")
 
-        # Carregar script e plano
-        script_content = files.load_text("script.md")
-        plan = files.load_json("plan.json")
+            script_content = script_future.result()
+            # Só tema e tom são usados aqui: não exigir o resto do plano
+            plan = Plan.from_dict(plan_future.result(), required=("tema", "tom")).to_dict()
 
         # Extrair visuals originais
         logger.info("📄 Extraindo descrições visuais...")
-        original_scenes = extract_visuals_from_script(script_content)
+        original_scenes = state.get("scenes") or ScriptParser.parse_script(script_content)
+        state["scenes"] = original_scenes
 
         if not original_scenes:
             logger.error("Nenhuma cena encontrada no script!")
@@ -161,26 +300,21 @@ def generate_image_prompts(script_path: str, output_dir: str):
         # Gerar prompts otimizados
         logger.info("⏳ Otimizando prompts com Ollama...")
 
-        optimized_prompts = []
-
-        for scene in scenes_visuals:
-            logger.info(f"  Cena {scene['numero']}/{len(scenes_visuals)}...")
-
-            context = f"Tema: {plan['tema']}, Tom: {plan['tom']}"
+        context = f"Tema: {plan['tema']}, Tom: {plan['tom']}"
+        if len(scenes_visuals) == 1:
+            results = [optimize_prompt(ollama, scenes_visuals[0], context, use_cache)]
+        else:
+            results = asyncio.run(optimize_prompts(ollama, scenes_visuals, context, use_cache))
 
-            prompt = PROMPT_OPTIMIZER.format(
-                visual_description=scene['visual'],
-                context=context
-            )
-
-            optimized = ollama.generate(prompt, model="mistral", temperature=0.5)
+        optimized_prompts = []
 
+        for scene, optimized in zip(scenes_visuals, results):
             optimized_prompts.append({
                 "numero": scene['numero'],
                 "timing": scene['timing'],
                 "visual_original": scene['visual'],
                 "prompt_otimizado": optimized,
-                "duracao": scene.get('duracao', int(scene['timing'].split('-')[1].replace('s', '')))
+                "duracao": scene['duracao']
             })
 
         # Estrutura final
@@ -192,6 +326,7 @@ def generate_image_prompts(script_path: str, output_dir: str):
 
         # Salvar prompts
         files.save_json("image_prompts.json", image_prompts_data)
+        state["image_prompts"] = image_prompts_data
 
         logger.info(f"✓ Prompts gerados com sucesso!")
         logger.info(f"  Cenas: {len(optimized_prompts)}")
@@ -223,8 +358,14 @@ def main():
         help="Diretório de saída"
     )
 
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Ignora prompts em cache e consulta o Ollama novamente ({PROMPT_CACHE_DIR})"
+    )
+
     args = parser.parse_args()
-    generate_image_prompts(args.input, args.output)
+    generate_image_prompts(args.input, args.output, use_cache=not args.no_cache)
 
 
 if __name__ == "__main__":
@@ -7,16 +7,19 @@ Output: PNG images (scene_001.png, scene_002.png, etc)
 """
 
 import argparse
+import io
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent))
 
-from utils import FileManager, logger
+from utils import FileManager, enable_lcm_lora, optimize_sd_pipeline, TURBO_GUIDANCE, TURBO_STEPS, logger
 
 try:
     import torch
-    from diffusers import StableDiffusionPipeline
+    from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
     import warnings
     warnings.filterwarnings("ignore")
 except ImportError as e:
@@ -26,11 +29,17 @@ except ImportError as e:
     sys.exit(1)
 
 
+# Steps por modo (DPM-Solver++ converge em 10-15 steps)
+QUALITY_STEPS = 15
+FAST_STEPS = 8
+
+
 class StableDiffusionGenerator:
     """Integração com Stable Diffusion via diffusers (local)"""
 
-    def __init__(self, device: str = "cpu"):
+    def __init__(self, device: str = "cpu", turbo: bool = False):
         self.device = device
+        self.turbo = turbo
         self.pipe = None
 
     def _init_pipeline(self):
@@ -60,13 +69,31 @@ class StableDiffusionGenerator:
                 low_cpu_mem_usage=True
             )
             self.pipe = self.pipe.to(self.device)
+
+            # DPM-Solver++: mesma qualidade com bem menos steps que o PNDM padrão
+            self.pipe.scheduler = DPMSolverMultistepScheduler.from_config(
+                self.pipe.scheduler.config,
+                algorithm_type="dpmsolver++",
+                use_karras_sigmas=True
+            )
+
+            # Modo turbo: LCM-LoRA (substitui o DPM-Solver++)
+            if self.turbo:
+                enable_lcm_lora(self.pipe)
             
             # Otimizações para pouca VRAM
             if self.device == "cuda":
-                self.pipe.enable_attention_slicing()
                 self.pipe.enable_model_cpu_offload()
                 logger.info("   Otimizações VRAM ativadas")
 
+            # Atenção fused (substitui o attention_slicing) + UNet compilada
+            optimize_sd_pipeline(
+                self.pipe,
+                compile_mode="default",
+                warmup_size=(720, 1280),
+                guidance_scale=TURBO_GUIDANCE if self.turbo else 7.5
+            )
+
             logger.info("✓ Modelo carregado")
 
         except ImportError:
@@ -85,102 +112,201 @@ class StableDiffusionGenerator:
         except Exception:
             return False
 
-    def generate_image(
+    def render_batch(
         self,
-        prompt: str,
+        prompts: list[str],
         negative_prompt: str = "low quality, blurry, distorted",
-        steps: int = 25,
+        steps: int = 15,
         width: int = 1280,
         height: int = 720,
         guidance_scale: float = 7.5,
-        sampler: str = None  # Não usado em diffusers
-    ) -> bytes:
-        """Gera imagem usando Stable Diffusion via diffusers"""
+        seed: int = 42
+    ) -> list:
+        """Gera várias imagens (PIL) em uma única chamada ao pipeline (uma por prompt)"""
 
         try:
             self._init_pipeline()
 
-            logger.info(f"  ⏳ Gerando imagem (steps={steps}, {width}x{height})...")
+            logger.info(f"  ⏳ Gerando {len(prompts)} imagem(ns) (steps={steps}, {width}x{height})...")
 
-            # Gerar imagem
+            # Um generator por prompt: mesma semente = mesma imagem, com ou sem lote
+            generators = [torch.Generator(self.device).manual_seed(seed) for _ in prompts]
+
+            # Gerar o lote inteiro
             with torch.no_grad():
-                image = self.pipe(
-                    prompt=prompt,
-                    negative_prompt=negative_prompt,
+                images = self.pipe(
+                    prompt=prompts,
+                    negative_prompt=[negative_prompt] * len(prompts),
                     height=height,
                     width=width,
                     num_inference_steps=steps,
                     guidance_scale=guidance_scale,
-                ).images[0]
+                    num_images_per_prompt=1,
+                    generator=generators,
+                ).images
 
-            # Converter para bytes
-            import io
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            
             # Limpar cache GPU
             if self.device == "cuda":
                 torch.cuda.empty_cache()
 
-            return img_byte_arr.getvalue()
+            return images
 
         except Exception as e:
-            logger.error(f"Erro ao gerar imagem: {e}")
+            logger.error(f"Erro ao gerar imagens: {e}")
             raise
 
+    def generate_batch(self, prompts: list[str], **kwargs) -> list[bytes]:
+        """Gera várias imagens em uma única chamada ao pipeline (PNG em bytes)"""
+        images_bytes = []
+        for image in self.render_batch(prompts, **kwargs):
+            img_byte_arr = io.BytesIO()
+            save_png(image, img_byte_arr)
+            images_bytes.append(img_byte_arr.getvalue())
+        return images_bytes
+
+    def generate_image(
+        self,
+        prompt: str,
+        negative_prompt: str = "low quality, blurry, distorted",
+        steps: int = 15,
+        width: int = 1280,
+        height: int = 720,
+        guidance_scale: float = 7.5,
+        sampler: str = None  # Não usado em diffusers
+    ) -> bytes:
+        """Gera imagem usando Stable Diffusion via diffusers"""
+        return self.generate_batch(
+            [prompt],
+            negative_prompt=negative_prompt,
+            steps=steps,
+            width=width,
+            height=height,
+            guidance_scale=guidance_scale
+        )[0]
+
+
+def save_png(image, output):
+    """Salva PNG intermediário (o FFmpeg re-encoda depois: compressão mínima,
+    bem mais rápido que o padrão compress_level=6)"""
+    image.save(output, format='PNG', compress_level=1, optimize=False)
+
+
+def save_scene_image(image, output_path: Path):
+    """Grava a imagem de uma cena (PIL.Image ou PNG já codificado pelo daemon)"""
+    if isinstance(image, bytes):
+        output_path.write_bytes(image)
+    else:
+        save_png(image, output_path)
+    logger.info(f"  ✓ Salvo: {output_path.name}")
+
+
+def default_batch_size() -> int:
+    """Cenas por lote conforme a VRAM (CPU: 1; ~1 cena a cada 4GB, máx 4)"""
+    if not torch.cuda.is_available():
+        return 1
+    total_gb = torch.cuda.get_device_properties(0).total_memory / 1024**3
+    return min(4, max(1, round(total_gb) // 4))
 
-def generate_images(prompts_file: str, output_dir: str, fast_mode: bool = False):
-    """Gera todas as imagens baseado nos prompts"""
+
+def generate_images(
+    prompts_file: str,
+    output_dir: str,
+    fast_mode: bool = False,
+    state: dict = None,
+    batch_size: int = 0,
+    steps: int = None,
+    turbo: bool = False
+):
+    """Gera todas as imagens baseado nos prompts (batch_size=0: automático pela VRAM)"""
+
+    state = state if state is not None else {}
 
     logger.info("🖼️  Geração de imagens")
 
     files = FileManager(output_dir)
 
     # Configurações por modo
-    if fast_mode:
-        steps = 15
-        logger.info("⚡ Modo rápido (steps=15)")
+    guidance_scale = 7.5
+    if turbo:
+        steps = steps or TURBO_STEPS
+        guidance_scale = TURBO_GUIDANCE
+        logger.info(f"⚡ Modo turbo LCM-LoRA (steps={steps})")
+    elif fast_mode:
+        steps = steps or FAST_STEPS
+        logger.info(f"⚡ Modo rápido (steps={steps})")
     else:
-        steps = 25
-        logger.info("🎨 Modo qualidade (steps=25)")
+        steps = steps or QUALITY_STEPS
+        logger.info(f"🎨 Modo qualidade (steps={steps})")
 
     try:
-        # Inicializar Stable Diffusion
-        sd = StableDiffusionGenerator()
-
-        logger.info("✓ Stable Diffusion pronto")
+        # Inicializar Stable Diffusion (ou usar o daemon com o modelo já carregado)
+        daemon_sock = os.environ.get("SD_DAEMON_SOCK")
+        if daemon_sock:
+            from sd_daemon import SDDaemonClient
+            sd = SDDaemonClient(daemon_sock)
+            if sd.turbo != turbo:
+                # Steps/CFG do turbo com o modelo errado dão imagens sub-amostradas
+                sd.close()
+                daemon_mode = "com" if sd.turbo else "sem"
+                raise RuntimeError(
+                    f"Daemon carregado {daemon_mode} --turbo: reinicie o sd_daemon.py "
+                    f"{'com' if turbo else 'sem'} --turbo ou ajuste o --turbo desta etapa"
+                )
+            render = sd.generate_batch  # Daemon já devolve PNG em bytes
+            logger.info(f"✓ Usando daemon Stable Diffusion ({daemon_sock})")
+        else:
+            sd = StableDiffusionGenerator(turbo=turbo)
+            render = sd.render_batch
+            logger.info("✓ Stable Diffusion pronto")
 
         # Carregar prompts
-        prompts_data = files.load_json("image_prompts.json")
+        prompts_data = state.get("image_prompts") or files.load_json("image_prompts.json")
 
-        total_scenes = len(prompts_data["cenas"])
+        scenes = prompts_data["cenas"]
+        total_scenes = len(scenes)
         logger.info(f"📋 {total_scenes} cenas para gerar\n")
 
-        # Gerar imagem para cada cena
-        for i, scene in enumerate(prompts_data["cenas"], 1):
-            try:
-                logger.info(f"[{i}/{total_scenes}] Cena {scene['numero']}:")
-                logger.info(f"  Prompt: {scene['prompt_otimizado'][:60]}...")
-
-                # Gerar imagem
-                image_bytes = sd.generate_image(
-                    prompt=scene['prompt_otimizado'],
-                    steps=steps
-                )
-
-                # Salvar imagem
-                output_path = files.get_image_path(scene['numero'])
-
-                with open(output_path, 'wb') as f:
-                    f.write(image_bytes)
-
-                logger.info(f"  ✓ Salvo: {output_path.name}")
-
-            except Exception as e:
-                logger.error(f"  ✗ Erro na cena {scene['numero']}: {e}")
-                logger.info("  (Continuando com próxima cena...)\n")
-                continue
+        batch_size = batch_size or default_batch_size()
+        logger.info(f"📦 {batch_size} cena(s) por lote")
+
+        # Gerar as imagens em lotes de cenas; a codificação/gravação roda em
+        # background enquanto a GPU já processa o próximo lote
+        pending_saves = []
+        with ThreadPoolExecutor(max_workers=2) as saver:
+            for batch_index in range(0, total_scenes, batch_size):
+                batch = scenes[batch_index:batch_index + batch_size]
+                try:
+                    for i, scene in enumerate(batch, batch_index + 1):
+                        logger.info(f"[{i}/{total_scenes}] Cena {scene['numero']}:")
+                        logger.info(f"  Prompt: {scene['prompt_otimizado'][:60]}...")
+
+                    # Gerar o lote
+                    images = render(
+                        [scene['prompt_otimizado'] for scene in batch],
+                        steps=steps,
+                        guidance_scale=guidance_scale
+                    )
+
+                    # Salvar imagens na ordem das cenas
+                    for scene, image in zip(batch, images):
+                        output_path = files.get_image_path(scene['numero'])
+                        pending_saves.append(
+                            (scene, saver.submit(save_scene_image, image, output_path))
+                        )
+
+                except Exception as e:
+                    numeros = ", ".join(str(scene['numero']) for scene in batch)
+                    logger.error(f"  ✗ Erro nas cenas {numeros}: {e}")
+                    logger.info("  (Continuando com próximo lote...)\n")
+                    continue
+
+        # Erros de gravação (o executor já esperou todas terminarem)
+        for scene, future in pending_saves:
+            if future.exception() is not None:
+                logger.error(f"  ✗ Erro ao salvar cena {scene['numero']}: {future.exception()}")
+
+        if daemon_sock:
+            sd.close()
 
         logger.info(f"\n✓ Geração de imagens concluída!")
         logger.info(f"  Pasta: {files.dirs['images']}")
@@ -209,9 +335,33 @@ def main():
         action="store_true",
         help="Modo rápido (menos steps, menos qualidade)"
     )
+    parser.add_argument(
+        "--turbo",
+        action="store_true",
+        help=f"LCM-LoRA: {TURBO_STEPS} steps sem CFG (muito mais rápido)"
+    )
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=None,
+        help=f"Steps de inferência (padrão: {QUALITY_STEPS}, ou {FAST_STEPS} com --fast)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=0,
+        help="Cenas por lote (padrão: automático pela VRAM)"
+    )
 
     args = parser.parse_args()
-    generate_images(args.input, args.output, fast_mode=args.fast)
+    generate_images(
+        args.input,
+        args.output,
+        fast_mode=args.fast,
+        batch_size=args.batch_size,
+        steps=args.steps,
+        turbo=args.turbo
+    )
 
 
 if __name__ == "__main__":
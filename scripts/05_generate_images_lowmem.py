@@ -12,14 +12,16 @@ import sys
 from pathlib import Path
 import time
 import gc
+import queue
+import threading
 
 sys.path.insert(0, str(Path(__file__).parent))
 
-from utils import FileManager, logger
+from utils import FileManager, enable_lcm_lora, optimize_sd_pipeline, TURBO_GUIDANCE, TURBO_STEPS, logger
 
 try:
     import torch
-    from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+    from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler, AutoencoderKL
     import warnings
     warnings.filterwarnings("ignore")
     
@@ -37,6 +39,21 @@ except ImportError as e:
     logger.error(f"Erro: {e}")
     sys.exit(1)
 
+try:
+    from torchao.quantization import quantize_, int8_weight_only
+except ImportError:
+    quantize_ = None  # Sem torchao: UNet em FP16 (sem quantização) na GPU
+
+try:
+    from torchao.quantization import float8_weight_only
+except ImportError:
+    float8_weight_only = None  # torchao antigo: só INT8
+
+
+# Steps de DPM-Solver++ (padrão e --fast)
+LOWMEM_STEPS = 8
+LOWMEM_FAST_STEPS = 6
+
 
 def truncate_prompt(prompt: str, max_tokens: int = 75) -> str:
     """Trunca prompt para evitar overflow do CLIP"""
@@ -57,10 +74,92 @@ def clear_memory():
         torch.cuda.synchronize()
 
 
-def generate_images_lowmem(prompts_file: str, output_dir: str):
-    """Versão otimizada para GPU de 4GB"""
+def quantize_unet(pipe) -> bool:
+    """Quantiza os pesos da UNet (FP8 em GPUs SM89+, senão INT8) com torchao"""
+    if quantize_ is None:
+        return False
+
+    if float8_weight_only is not None and torch.cuda.get_device_capability(0) >= (8, 9):
+        quantize_(pipe.unet, float8_weight_only())
+        logger.info("   UNet quantizada: FP8 (pesos)")
+    else:
+        quantize_(pipe.unet, int8_weight_only())
+        logger.info("   UNet quantizada: INT8 (pesos)")
+    return True
+
+
+def auto_batch_size(gpu_memory_gb: float) -> int:
+    """Cenas por lote conforme a VRAM (4GB -> 1, 8GB -> 2, ..., máx 4)"""
+    return min(4, max(1, round(gpu_memory_gb) // 4))
+
+
+def decode_latents(vae, image_processor, latents) -> list:
+    """Decodifica latents com o VAE (no dispositivo/dtype do VAE) em imagens PIL"""
+    with torch.no_grad():
+        latents = latents.to(vae.device, dtype=vae.dtype) / vae.config.scaling_factor
+        decoded = vae.decode(latents).sample
+    images = image_processor.postprocess(decoded, output_type="pil")
+    del latents, decoded  # Libera a ativação do VAE antes do próximo lote
+    return images
+
+
+def decode_worker(vae, image_processor, latents_queue: queue.Queue, files: FileManager):
+    """Consumidor: salva as imagens (e, com o VAE da CPU, decodifica antes)
+
+    Roda em paralelo ao denoising: enquanto a GPU processa a cena k+1,
+    esta thread grava a cena k. Sem vae, as imagens já chegam decodificadas.
+    """
+    while True:
+        item = latents_queue.get()
+        if item is None:
+            break
+
+        scene, payload, scene_start = item
+        try:
+            if vae is None:
+                image = payload
+            else:
+                decode_start = time.time()
+                image = decode_latents(vae, image_processor, payload)[0]
+                logger.info(f"  ⏱️  Decode CPU cena {scene['numero']}: {time.time() - decode_start:.2f}s")
+
+            output_path = files.get_image_path(scene['numero'])
+            image.save(output_path, "JPEG", quality=90, optimize=True)
+
+            scene_time = time.time() - scene_start
+            logger.info(f"  ✓ {output_path.name} ({scene_time:.1f}s)")
+        except Exception as e:
+            logger.error(f"  ❌ Erro ao decodificar cena {scene['numero']}: {e}")
+
+
+def generate_images_lowmem(
+    prompts_file: str,
+    output_dir: str,
+    state: dict = None,
+    batch_size: int = 0,
+    turbo: bool = False,
+    steps: int = LOWMEM_STEPS,
+    fast: bool = False,
+    cpu_decode: bool = False
+):
+    """Versão otimizada para GPU de 4GB (batch_size=0: automático pela VRAM)
+
+    O VAE decodifica na GPU (com tiles) por padrão; cpu_decode=True usa um VAE
+    float32 na CPU em paralelo ao denoising (só compensa com CPU rápida).
+    """
 
-    logger.info("🔥 MODO LOW-MEMORY (512x512, 8 steps, otimizações agressivas)")
+    state = state if state is not None else {}
+
+    # Turbo: LCM-LoRA com 4 steps e sem CFG; fast: menos steps de DPM-Solver++
+    if turbo:
+        num_steps = TURBO_STEPS
+    elif fast:
+        num_steps = min(steps, LOWMEM_FAST_STEPS)
+    else:
+        num_steps = steps
+    guidance_scale = TURBO_GUIDANCE if turbo else 7.5
+
+    logger.info(f"🔥 MODO LOW-MEMORY (512x512, {num_steps} steps, otimizações agressivas)")
     
     files = FileManager(output_dir)
     
@@ -81,32 +180,67 @@ def generate_images_lowmem(prompts_file: str, output_dir: str):
     start_time = time.time()
     logger.info("📥 Carregando modelo com otimizações extremas...")
     
-    # Carregar modelo com configurações mínimas de memória
+    # Carregar modelo com configurações mínimas de memória. Sem safety checker
+    # (~600MB em FP16 na GPU): com output_type="latent" ele nunca roda
     pipe = StableDiffusionPipeline.from_pretrained(
         "runwayml/stable-diffusion-v1-5",
         torch_dtype=dtype,
         low_cpu_mem_usage=True,
         use_safetensors=True,
-        variant="fp16"
+        variant="fp16",
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
     )
     
     # Scheduler mais eficiente
     pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+
+    # LoRA fundido antes da quantização (pesos quantizados não aceitam fuse)
+    if turbo:
+        enable_lcm_lora(pipe)
     
-    # Otimizações agressivas de memória
-    pipe.enable_model_cpu_offload()  # Mais agressivo que attention_slicing
+    # UNet residente na GPU, sem cpu_offload (que move a UNet inteira pelo PCIe
+    # a cada chamada). A UNet vai antes para a GPU: o torchao quantiza no
+    # dispositivo de destino
+    pipe.unet.to(device)
+    if not quantize_unet(pipe):
+        logger.info("   torchao não instalado: UNet em FP16 (pip install torchao)")
+    pipe = pipe.to(device)
+
+    # VAE da GPU: tiles pequenos para o decode caber em 4GB
     pipe.enable_vae_slicing() 
-    pipe.enable_vae_tiling()
-    pipe.enable_attention_slicing(1)  # Slice máximo
-    
-    # Não mover para GPU ainda - deixar o cpu_offload gerenciar
+    pipe.vae.enable_tiling()
+    pipe.vae.tile_sample_min_size = 256
+    pipe.vae.tile_latent_min_size = 256 // 8
+
+    # Atenção fused no lugar do attention_slicing (menos memória e mais rápida)
+    torch.cuda.reset_peak_memory_stats()
+    optimize_sd_pipeline(
+        pipe,
+        compile_mode="reduce-overhead",
+        warmup_size=(512, 512),
+        guidance_scale=guidance_scale
+    )
+
+    # Opcional: VAE separado em float32 na CPU para decodificar em paralelo com a GPU
+    vae_cpu = None
+    if cpu_decode:
+        vae_cpu = AutoencoderKL.from_pretrained(
+            "runwayml/stable-diffusion-v1-5",
+            subfolder="vae",
+            torch_dtype=torch.float32,
+            use_safetensors=True
+        )
+        vae_cpu.eval()
+        logger.info("   Decode do VAE na CPU (--cpu-decode)")
     
     load_time = time.time() - start_time
     logger.info(f"✅ Modelo carregado em {load_time:.1f}s com otimizações extremas")
     
     # Carregar prompts
     try:
-        prompts_data = files.load_json("image_prompts.json")
+        prompts_data = state.get("image_prompts") or files.load_json("image_prompts.json")
         total_scenes = len(prompts_data["cenas"])
     except Exception as e:
         logger.error(f"❌ Erro ao carregar prompts: {e}")
@@ -114,79 +248,120 @@ def generate_images_lowmem(prompts_file: str, output_dir: str):
     
     logger.info(f"📋 {total_scenes} cenas para gerar\n")
     
-    # Gerar imagens
+    # Gerar imagens (GPU: denoising [+ VAE] -> fila -> thread: [VAE na CPU +] salvar)
     total_start = time.time()
+
+    latents_queue = queue.Queue(maxsize=2)
+    decoder = threading.Thread(
+        target=decode_worker,
+        args=(vae_cpu, pipe.image_processor, latents_queue, files),
+        daemon=True
+    )
+    decoder.start()
     
-    for i, scene in enumerate(prompts_data["cenas"], 1):
+    scenes = prompts_data["cenas"]
+    batch_size = batch_size or auto_batch_size(gpu_memory)
+    logger.info(f"📦 {batch_size} cena(s) por lote")
+
+    # Ruído inicial alocado uma única vez (semente 42 em todas as cenas, como antes):
+    # cada lote usa uma fatia, sem novo Generator nem cudaMalloc por chamada
+    generator = torch.Generator(device)
+    latents_buffer = torch.empty(
+        (batch_size, pipe.unet.config.in_channels, 512 // pipe.vae_scale_factor, 512 // pipe.vae_scale_factor),
+        device=device,
+        dtype=dtype
+    )
+    for row in latents_buffer:
+        generator.manual_seed(42)
+        row.normal_(generator=generator)
+
+    for batch_index in range(0, total_scenes, batch_size):
+        batch = scenes[batch_index:batch_index + batch_size]
+        batch_label = ", ".join(str(scene['numero']) for scene in batch)
+
         try:
-            scene_start = time.time()
-            logger.info(f"[{i}/{total_scenes}] Cena {scene['numero']}...")
+            batch_start = time.time()
+            for i, scene in enumerate(batch, batch_index + 1):
+                logger.info(f"[{i}/{total_scenes}] Cena {scene['numero']}...")
             
-            # Limpar memória antes de cada geração
-            clear_memory()
+            # Sem clear_memory() entre lotes: o caching allocator reaproveita os blocos
+            # (só limpamos no OutOfMemoryError)
             
-            # Preparar prompt (truncar para evitar overflow)
-            prompt = truncate_prompt(scene['prompt_otimizado'], max_tokens=75)
-            negative_prompt = "low quality, blurry"
+            # Preparar prompts (truncar para evitar overflow)
+            prompts = [truncate_prompt(scene['prompt_otimizado'], max_tokens=75) for scene in batch]
+            negative_prompts = ["low quality, blurry"] * len(batch)
             
             # Monitorar memória
             if torch.cuda.is_available():
                 memory_before = torch.cuda.memory_allocated() / 1024**3
                 logger.info(f"  💾 Memória antes: {memory_before:.2f}GB")
             
-            # Gerar com configurações mínimas
+            # Gerar o lote inteiro em uma chamada (só o denoising; o VAE vem depois)
+            unet_start = time.time()
             with torch.no_grad():
-                image = pipe(
-                    prompt=prompt,
-                    negative_prompt=negative_prompt,
+                latents = pipe(
+                    prompt=prompts,
+                    negative_prompt=negative_prompts,
                     height=512,              # Resolução mínima para qualidade aceitável
                     width=512,
-                    num_inference_steps=8,   # Menos steps = menos memória
-                    guidance_scale=7.5,      # Padrão
-                    generator=torch.Generator(device).manual_seed(42),
-                ).images[0]
+                    num_inference_steps=num_steps,     # Menos steps = menos memória
+                    guidance_scale=guidance_scale,     # Padrão (1.0 no turbo)
+                    latents=latents_buffer[:len(batch)],
+                    output_type="latent",
+                ).images
             
-            # Salvar imagem
-            output_path = files.get_image_path(scene['numero'])
-            image.save(output_path, "JPEG", quality=90, optimize=True)
-            
-            scene_time = time.time() - scene_start
-            logger.info(f"  ✓ {output_path.name} ({scene_time:.1f}s)")
-            
-            # Limpar memória após cada geração
-            clear_memory()
+            torch.cuda.synchronize()
+            logger.info(f"  ⏱️  UNet do lote: {time.time() - unet_start:.2f}s")
+
+            if vae_cpu is not None:
+                # Entregar os latents para a thread decodificar na CPU
+                for scene, scene_latents in zip(batch, latents.cpu()):
+                    latents_queue.put((scene, scene_latents.unsqueeze(0), batch_start))
+            else:
+                # Decode na GPU com tiles; a thread só grava
+                decode_start = time.time()
+                images = decode_latents(pipe.vae, pipe.image_processor, latents)
+                logger.info(f"  ⏱️  Decode GPU do lote: {time.time() - decode_start:.2f}s")
+                for scene, image in zip(batch, images):
+                    latents_queue.put((scene, image, batch_start))
+            del latents
             
             if torch.cuda.is_available():
                 memory_after = torch.cuda.memory_allocated() / 1024**3
                 logger.info(f"  💾 Memória depois: {memory_after:.2f}GB")
                 
         except torch.cuda.OutOfMemoryError as e:
-            logger.error(f"  ❌ CUDA Out of Memory na cena {scene['numero']}")
+            logger.error(f"  ❌ CUDA Out of Memory nas cenas {batch_label}")
             logger.error("  💡 Tentando limpar memória e continuar...")
             
             # Limpeza agressiva
             clear_memory()
             
-            try:
-                # Tentar novamente com configurações ainda menores
-                with torch.no_grad():
-                    image = pipe(
-                        prompt=truncate_prompt(scene['prompt_otimizado'], max_tokens=50),
-                        height=384,              # Ainda menor
-                        width=384,
-                        num_inference_steps=6,   # Menos steps ainda
-                        guidance_scale=6.0,      # Menor guidance
-                    ).images[0]
-                
-                output_path = files.get_image_path(scene['numero'])
-                image.save(output_path, "JPEG", quality=85)
-                logger.info(f"  ✓ {output_path.name} (modo emergência 384x384)")
-                
-            except Exception as e2:
-                logger.error(f"  ❌ Falha total na cena {scene['numero']}: {e2}")
+            # Tentar novamente cena a cena, com configurações ainda menores
+            for scene in batch:
+                try:
+                    with torch.no_grad():
+                        image = pipe(
+                            prompt=truncate_prompt(scene['prompt_otimizado'], max_tokens=50),
+                            height=384,              # Ainda menor
+                            width=384,
+                            num_inference_steps=6,   # Menos steps ainda
+                            guidance_scale=6.0,      # Menor guidance
+                        ).images[0]
+                    
+                    output_path = files.get_image_path(scene['numero'])
+                    image.save(output_path, "JPEG", quality=85)
+                    logger.info(f"  ✓ {output_path.name} (modo emergência 384x384)")
+                    
+                except Exception as e2:
+                    logger.error(f"  ❌ Falha total na cena {scene['numero']}: {e2}")
                 
         except Exception as e:
-            logger.error(f"  ❌ Erro na cena {scene['numero']}: {e}")
+            logger.error(f"  ❌ Erro nas cenas {batch_label}: {e}")
+
+    # Aguardar a decodificação das últimas cenas
+    latents_queue.put(None)
+    decoder.join()
     
     total_time = time.time() - total_start
     avg_time = total_time / total_scenes if total_scenes > 0 else 0
@@ -195,13 +370,18 @@ def generate_images_lowmem(prompts_file: str, output_dir: str):
     logger.info(f"⏱️  Tempo total: {total_time:.1f}s")
     logger.info(f"📊 Média por imagem: {avg_time:.1f}s")
     logger.info(f"🖼️  Resolução: 512x512 (otimizado para GPU 4GB)")
+    logger.info(f"💾 Pico de memória GPU: {torch.cuda.max_memory_allocated() / 1024**3:.2f}GB")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Gerador otimizado para GPU de 4GB")
     parser.add_argument("--output", default="output/default", help="Diretório de saída")
-    parser.add_argument("--steps", type=int, default=8, help="Número de steps (padrão: 8)")
+    parser.add_argument("--steps", type=int, default=LOWMEM_STEPS, help=f"Número de steps (padrão: {LOWMEM_STEPS})")
+    parser.add_argument("--fast", action="store_true", help=f"Modo rápido ({LOWMEM_FAST_STEPS} steps)")
     parser.add_argument("--size", type=int, default=512, help="Tamanho da imagem (padrão: 512)")
+    parser.add_argument("--batch-size", type=int, default=0, help="Cenas por lote (padrão: automático pela VRAM)")
+    parser.add_argument("--turbo", action="store_true", help=f"LCM-LoRA: {TURBO_STEPS} steps sem CFG")
+    parser.add_argument("--cpu-decode", action="store_true", help="Decodifica o VAE na CPU, em paralelo à GPU")
     
     args = parser.parse_args()
     
@@ -214,4 +394,12 @@ if __name__ == "__main__":
         logger.warning("⚠️  Resolução alta demais para GPU 4GB. Usando 512x512.")
         args.size = 512
     
-    generate_images_lowmem("image_prompts.json", args.output)
\ No newline at end of file
+    generate_images_lowmem(
+        "image_prompts.json",
+        args.output,
+        batch_size=args.batch_size,
+        turbo=args.turbo,
+        steps=args.steps,
+        fast=args.fast,
+        cpu_decode=args.cpu_decode
+    )
\ No newline at end of file
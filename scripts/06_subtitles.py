@@ -10,22 +10,38 @@ import argparse
 import sys
 import re
 from pathlib import Path
+from typing import Iterable, Optional
 
 sys.path.insert(0, str(Path(__file__).parent))
 
-from utils import FileManager, ScriptParser, timestamp_to_srt_time, logger
+from utils import FileManager, ScriptParser, format_hms, split_timestamp, logger
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Sem NumPy: timings calculados linha a linha
 
-def extract_scenes_with_timing(script_content: str) -> list[dict]:
-    """Extrai cenas com timing do script"""
+# A partir de quantas linhas de legenda vale vetorizar os timings com NumPy
+NUMPY_MIN_LINES = 256
+
+# Buffer de escrita dos arquivos de legenda
+SUBTITLE_BUFFER = 1 << 16
+
+# Cabeçalho de cena (## CENA X (Y-Zs)), compilado uma única vez
+_CENA_MARKER = "## CENA"
+_CENA_RE = re.compile(r'## CENA (\d+) \((\d+)-(\d+)s\)')
+
+
+def extract_scenes_with_timing(lines: Iterable[str]) -> list[dict]:
+    """Extrai cenas com timing do script (linhas do arquivo, lidas uma a uma)"""
 
     scenes = []
-    lines = script_content.split('\n')
     current_scene = None
 
     for line in lines:
-        # Detectar cabeçalho de cena (## CENA X (Y-Zs))
-        match = re.search(r'## CENA (\d+) \((\d+)-(\d+)s\)', line)
+        # Detectar cabeçalho de cena (## CENA X (Y-Zs)); a busca por substring
+        # descarta as demais linhas sem passar pelo regex
+        match = _CENA_RE.search(line) if _CENA_MARKER in line else None
         if match:
             if current_scene:
                 scenes.append(current_scene)
@@ -47,61 +63,80 @@ def extract_scenes_with_timing(script_content: str) -> list[dict]:
     return scenes
 
 
-def format_srt_time(seconds: float) -> str:
-    """Converte segundos para formato SRT (HH:MM:SS,mmm)"""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
-    millis = int((seconds % 1) * 1000)
-    return f"{hours:02d}:{minutes:02d}:{secs:02d},{millis:03d}"
+def _split_timestamp_array(seconds) -> tuple[list[str], list[int]]:
+    """Versão vetorizada de split_timestamp (array NumPy de segundos)"""
+    total_secs, millis = np.divmod((seconds * 1000).astype(np.int64), 1000)
+    return [format_hms(secs) for secs in total_secs.tolist()], millis.tolist()
+
+
+def compute_line_times(scene_timings: list[tuple[int, int, int]]) -> list[tuple[str, int, str, int]]:
+    """(início HMS, início ms, fim HMS, fim ms) de cada linha de legenda
+
+    scene_timings: (início da cena, fim da cena, número de linhas > 0). O tempo
+    da cena é dividido igualmente entre as linhas; com NumPy e muitas linhas o
+    cálculo é vetorizado (mesmas operações em float64, mesmo resultado).
+    """
+    total_lines = sum(n_lines for _, _, n_lines in scene_timings)
+
+    if np is None or total_lines < NUMPY_MIN_LINES:
+        times = []
+        for start_sec, end_sec, n_lines in scene_timings:
+            time_per_line = (end_sec - start_sec) / n_lines
+            for j in range(n_lines):
+                times.append((
+                    *split_timestamp(start_sec + (j * time_per_line)),
+                    *split_timestamp(start_sec + ((j + 1) * time_per_line))
+                ))
+        return times
+
+    starts, ends, counts = (np.array(column) for column in zip(*scene_timings))
+    time_per_line = np.repeat((ends - starts) / counts, counts)
+    scene_starts = np.repeat(starts.astype(np.float64), counts)
 
+    # Índice da linha dentro da sua cena (0, 1, ..., n-1 para cada cena)
+    line_index = np.arange(total_lines) - np.repeat(np.cumsum(counts) - counts, counts)
 
-def format_vtt_time(seconds: float) -> str:
-    """Converte segundos para formato VTT (HH:MM:SS.mmm)"""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
-    millis = int((seconds % 1) * 1000)
-    return f"{hours:02d}:{minutes:02d}:{secs:02d}.{millis:03d}"
+    start_hms, start_ms = _split_timestamp_array(scene_starts + line_index * time_per_line)
+    end_hms, end_ms = _split_timestamp_array(scene_starts + (line_index + 1) * time_per_line)
+    return list(zip(start_hms, start_ms, end_hms, end_ms))
 
 
 def split_text_into_lines(text: str, max_chars: int = 42) -> list[str]:
     """Divide texto em linhas para legendas (máx 42 chars por linha)"""
 
-    words = text.split()
     lines = []
-    current_line = ""
-
-    for word in words:
-        if len(current_line) + len(word) + 1 <= max_chars:
-            if current_line:
-                current_line += " " + word
-            else:
-                current_line = word
+    buf: list[str] = []  # Palavras da linha atual (unidas só ao fechar a linha)
+    cur_len = 0
+
+    for word in text.split():
+        word_len = len(word)
+        if buf and cur_len + word_len + 1 > max_chars:
+            lines.append(" ".join(buf))
+            buf = [word]
+            cur_len = word_len
         else:
-            if current_line:
-                lines.append(current_line)
-            current_line = word
+            cur_len += word_len + 1 if buf else word_len
+            buf.append(word)
 
-    if current_line:
-        lines.append(current_line)
+    if buf:
+        lines.append(" ".join(buf))
 
     return lines
 
 
-def create_subtitles(script_path: str, output_dir: str):
-    """Cria legendas em formato SRT e VTT"""
+def create_subtitles(script_path: str, output_dir: str, return_content: bool = False) -> Optional[str]:
+    """Cria legendas em formato SRT e VTT
+
+    Com return_content=True retorna também o conteúdo SRT (senão None).
+    """
 
     logger.info("📝 Geração de legendas")
 
     files = FileManager(output_dir)
 
     try:
-        # Carregar script
-        script_content = files.load_text("script.md")
-
-        # Extrair cenas com timing
-        scenes = extract_scenes_with_timing(script_content)
+        # Extrair cenas com timing (script lido linha a linha, sem cópia inteira)
+        scenes = extract_scenes_with_timing(files.load_lines("script.md"))
 
         if not scenes:
             logger.error("Nenhuma cena encontrada!")
@@ -109,48 +144,55 @@ def create_subtitles(script_path: str, output_dir: str):
 
         logger.info(f"📄 Processando {len(scenes)} cenas...")
 
-        # Gerar SRT
-        srt_content = ""
-        vtt_content = "WEBVTT\n\n"
+        # Dividir narrações em linhas e calcular o timing de todas de uma vez
+        # (cada cena divide seu tempo entre as suas linhas)
+        subtitle_lines: list[str] = []
+        scene_timings: list[tuple[int, int, int]] = []
+        for scene in scenes:
+            lines = split_text_into_lines(scene["naracao"])
+            if lines:
+                subtitle_lines.extend(lines)
+                scene_timings.append((scene["start_seconds"], scene["end_seconds"], len(lines)))
+
+        line_times = compute_line_times(scene_timings)
+
+        # Gerar SRT e VTT escrevendo direto nos arquivos
+        srt_path = files.output_dir / "subtitles.srt"
+        vtt_path = files.output_dir / "subtitles.vtt"
+        srt_parts: Optional[list[str]] = [] if return_content else None
         subtitle_counter = 1
 
-        for i, scene in enumerate(scenes, 1):
-            # Dividir narração em linhas
-            naracao = scene["naracao"]
-            lines = split_text_into_lines(naracao)
-
-            # Calcular timing para cada linha (dividir o tempo da cena)
-            start_sec = scene["start_seconds"]
-            end_sec = scene["end_seconds"]
-            total_duration = end_sec - start_sec
-
-            if len(lines) > 0:
-                time_per_line = total_duration / len(lines)
-
-                for j, line in enumerate(lines):
-                    line_start = start_sec + (j * time_per_line)
-                    line_end = start_sec + ((j + 1) * time_per_line)
-
-                    # Formato SRT
-                    srt_content += f"{subtitle_counter}\n"
-                    srt_content += f"{format_srt_time(line_start)} --> {format_srt_time(line_end)}\n"
-                    srt_content += f"{line}\n\n"
-                    subtitle_counter += 1
-
-                    # Formato VTT
-                    vtt_content += f"{format_vtt_time(line_start)} --> {format_vtt_time(line_end)}\n"
-                    vtt_content += f"{line}\n\n"
-
-        # Salvar arquivos
-        files.save_text("subtitles.srt", srt_content)
-        files.save_text("subtitles.vtt", vtt_content)
+        with open(srt_path, "w", encoding="utf-8", buffering=SUBTITLE_BUFFER) as srt_file, \
+                open(vtt_path, "w", encoding="utf-8", buffering=SUBTITLE_BUFFER) as vtt_file:
+            vtt_file.write("WEBVTT\n\n")
+
+            for line, (start_hms, start_ms, end_hms, end_ms) in zip(subtitle_lines, line_times):
+                # Formato SRT
+                srt_entry = (
+                    f"{subtitle_counter}\n"
+                    f"{start_hms},{start_ms:03d} --> {end_hms},{end_ms:03d}\n"
+                    f"{line}\n\n"
+                )
+                srt_file.write(srt_entry)
+                if srt_parts is not None:
+                    srt_parts.append(srt_entry)
+                subtitle_counter += 1
+
+                # Formato VTT
+                vtt_file.write(
+                    f"{start_hms}.{start_ms:03d} --> {end_hms}.{end_ms:03d}\n"
+                    f"{line}\n\n"
+                )
+
+        logger.info(f"✓ Salvo: {srt_path.name}")
+        logger.info(f"✓ Salvo: {vtt_path.name}")
 
         logger.info(f"✓ Legendas criadas com sucesso!")
         logger.info(f"  SRT: subtitles.srt")
         logger.info(f"  VTT: subtitles.vtt")
-        logger.info(f"  Total de linhas: {len(vtt_content.split(chr(10))) // 3}")
+        logger.info(f"  Total de linhas: {subtitle_counter - 1}")
 
-        return srt_content
+        return "".join(srt_parts) if srt_parts is not None else None
 
     except Exception as e:
         logger.error(f"✗ Erro ao gerar legendas: {e}")
@@ -2,22 +2,26 @@
 """
 07_compose_video.py - Composição do vídeo final (Etapa 6)
 
-Input: Images (scene_*.png) + Audio (narration.wav)  
+Input: Images (scene_*.png ou scene_*.jpg) + Audio (narration.wav)  
 Output: video_final.mp4
 """
 
 import argparse
+import functools
+import os
 import sys
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent))
 
-from utils import FileManager, VideoComposer, logger
+from utils import FileManager, VideoComposer, detect_h264_encoder, h264_encoder_args, logger
 
 
+@functools.lru_cache(maxsize=1)
 def check_ffmpeg():
-    """Verifica se FFmpeg está instalado"""
+    """Verifica se FFmpeg está instalado (uma vez por processo)"""
     try:
         result = subprocess.run(
             ["ffmpeg", "-version"],
@@ -29,6 +33,79 @@ def check_ffmpeg():
         return False
 
 
+@functools.lru_cache(maxsize=32)
+def _audio_duration(audio_path: str, mtime: float) -> float:
+    """Duração do áudio via ffprobe (cache por arquivo + mtime: refaz só se mudar)"""
+    result = subprocess.run([
+        "ffprobe", "-i", audio_path,
+        "-show_entries", "format=duration",
+        "-v", "quiet", "-of", "csv=p=0"
+    ], capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+
+
+def get_audio_duration(audio_file: Path) -> float:
+    """Obtém duração do áudio em segundos"""
+    return _audio_duration(str(audio_file), os.path.getmtime(audio_file))
+
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+
+def is_jpeg_file(image_path: Path) -> bool:
+    """Detecta (pelos bytes iniciais) se a imagem é JPEG, qualquer que seja a extensão"""
+    try:
+        with open(image_path, "rb") as f:
+            return f.read(3) == JPEG_MAGIC
+    except OSError:
+        return False
+
+
+def convert_to_png(image_path: Path) -> Path:
+    """Converte uma imagem JPEG para PNG com o FFmpeg (remove o .jpg)"""
+    png_path = image_path.with_suffix(".png")
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-i", str(image_path), str(png_path)],
+        capture_output=True,
+        check=True
+    )
+    image_path.unlink()
+    return png_path
+
+
+def find_scene_images(images_dir: Path) -> list[Path]:
+    """Imagens das cenas em ordem (scene_*.png ou scene_*.jpg; a mais recente por cena)
+
+    Uma única passada com os.scandir (stat já vem no DirEntry).
+    """
+    latest = {}
+    with os.scandir(images_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if not (name.startswith("scene_") and name.endswith((".png", ".jpg"))):
+                continue
+            stem = name[:-4]
+            mtime = entry.stat().st_mtime
+            if stem not in latest or mtime > latest[stem][0]:
+                latest[stem] = (mtime, entry.path)
+    return [Path(latest[stem][1]) for stem in sorted(latest)]
+
+
+def write_concat_list(images_dir: Path, images: list[Path], duration: float) -> Path:
+    """Escreve a lista do concat demuxer do FFmpeg (uma duração por imagem)"""
+    lines = []
+    for image in images:
+        lines.append(f"file '{image.name}'")
+        lines.append(f"duration {duration:.3f}")
+
+    # O concat ignora a duração da última entrada se ela não for repetida
+    lines.append(f"file '{images[-1].name}'")
+
+    concat_file = images_dir / "concat.txt"
+    concat_file.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return concat_file
+
+
 def compose_video(project_dir: str, fps: int = 30, crf: int = 18, quality: str = "high"):
     """Compõe vídeo final com FFmpeg"""
 
@@ -48,22 +125,30 @@ def compose_video(project_dir: str, fps: int = 30, crf: int = 18, quality: str =
         logger.info("🎨 Modo alta qualidade")
 
     try:
+        images_dir = files.dirs["images"]
+        audio_file = files.get_audio_path()
+        subtitle_file = files.output_dir / "subtitles.srt"
+
+        # Verificações independentes (subprocessos e leitura do diretório) em paralelo
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            ffmpeg_future = pool.submit(check_ffmpeg)
+            encoder_future = pool.submit(detect_h264_encoder)
+            images_future = pool.submit(find_scene_images, images_dir) if images_dir.exists() else None
+            duration_future = pool.submit(get_audio_duration, audio_file) if audio_file.exists() else None
+
         # Verificar FFmpeg
-        if not check_ffmpeg():
+        if not ffmpeg_future.result():
             logger.error("❌ FFmpeg não encontrado!")
             logger.error("Execute: brew install ffmpeg")
             raise RuntimeError("FFmpeg não disponível")
 
         # Verificar arquivos necessários
-        images_dir = files.dirs["images"]
-        audio_file = files.get_audio_path()
-        subtitle_file = files.output_dir / "subtitles.srt"
-
-        if not images_dir.exists() or not list(images_dir.glob("scene_*.png")):
+        scene_images = images_future.result() if images_future else []
+        if not scene_images:
             logger.error("❌ Nenhuma imagem encontrada!")
             raise FileNotFoundError(f"Imagens não encontradas em {images_dir}")
 
-        if not audio_file.exists():
+        if duration_future is None:
             logger.error("❌ Arquivo de áudio não encontrado!")
             raise FileNotFoundError(f"Áudio não encontrado: {audio_file}")
 
@@ -71,33 +156,35 @@ def compose_video(project_dir: str, fps: int = 30, crf: int = 18, quality: str =
             logger.warning("⚠️  Legendas não encontradas (prosseguindo sem)")
             subtitle_file = None
 
-        # Verificar e corrigir formato das imagens
-        first_image = images_dir / "scene_001.png"
-        if first_image.exists():
-            # Detectar se imagens são JPEG com extensão PNG
-            result = subprocess.run(["file", str(first_image)], capture_output=True, text=True)
-            if "JPEG" in result.stdout:
-                logger.warning("⚠️  Imagens são JPEG com extensão .png, convertendo...")
-                # Converter todas as imagens
-                for img_file in images_dir.glob("scene_*.png"):
-                    temp_jpg = img_file.with_suffix(".temp.jpg")
-                    subprocess.run(["mv", str(img_file), str(temp_jpg)], check=True)
-                    subprocess.run(["ffmpeg", "-y", "-i", str(temp_jpg), str(img_file)], 
-                                 capture_output=True, check=True)
-                    temp_jpg.unlink()
-                logger.info("✅ Imagens convertidas para PNG")
-
-        # Contar imagens
-        num_images = len(list(images_dir.glob("scene_*.png")))
+        # Verificar formato das imagens (PNG de verdade: nada a fazer)
+        # Detectar imagens JPEG com extensão PNG, arquivo por arquivo
+        mislabeled = [
+            img_file for img_file in scene_images
+            if img_file.suffix == ".png" and is_jpeg_file(img_file)
+        ]
+        if mislabeled:
+            # Só corrigir a extensão: o concat demuxer lê JPEG direto, sem re-encode
+            logger.warning(f"⚠️  {len(mislabeled)} imagem(ns) JPEG com extensão .png, renomeando para .jpg...")
+            renamed = {img_file: img_file.rename(img_file.with_suffix(".jpg")) for img_file in mislabeled}
+            scene_images = [renamed.get(img_file, img_file) for img_file in scene_images]
+            logger.info("✅ Imagens renomeadas para .jpg")
+
+        # O concat demuxer exige um único codec: com PNG e JPEG misturados (ex.: cenas
+        # do modo emergência), converter os JPEG para PNG
+        jpeg_images = [img_file for img_file in scene_images if img_file.suffix == ".jpg"]
+        if jpeg_images and len(jpeg_images) < len(scene_images):
+            logger.warning(f"⚠️  PNG e JPEG misturados, convertendo {len(jpeg_images)} imagem(ns) para .png...")
+            with ThreadPoolExecutor() as pool:
+                converted = dict(zip(jpeg_images, pool.map(convert_to_png, jpeg_images)))
+            scene_images = [converted.get(img_file, img_file) for img_file in scene_images]
+            logger.info("✅ Imagens convertidas para .png")
+
+        # Contar imagens (lista já levantada acima)
+        num_images = len(scene_images)
         logger.info(f"📋 {num_images} imagens encontradas")
 
         # Obter duração do áudio
-        result = subprocess.run([
-            "ffprobe", "-i", str(audio_file), 
-            "-show_entries", "format=duration", 
-            "-v", "quiet", "-of", "csv=p=0"
-        ], capture_output=True, text=True, check=True)
-        audio_duration = float(result.stdout.strip())
+        audio_duration = duration_future.result()
         
         # Calcular duração ideal por imagem (10-15 segundos cada)
         ideal_duration_per_image = 12.0  # segundos
@@ -115,27 +202,31 @@ def compose_video(project_dir: str, fps: int = 30, crf: int = 18, quality: str =
             duration_per_image = ideal_duration_per_image
             logger.info(f"✨ Usando {ideal_num_images} primeiras imagens")
 
-        # Construir comando FFmpeg
-        image_pattern = str(images_dir / "scene_%03d.png")
+        # Lista do concat demuxer: cada imagem pelo mesmo tempo, cobrindo todo o áudio
+        concat_file = write_concat_list(images_dir, scene_images, audio_duration / num_images)
         output_file = str(files.output_dir / "video_final.mp4")
 
-        logger.info(f"⏳ Compilando vídeo (fps={fps}, crf={crf})...")
+        encoder = encoder_future.result()
+
+        logger.info(f"⏳ Compilando vídeo (fps={fps}, crf={crf}, encoder={encoder})...")
         logger.info("(Este processo pode levar alguns minutos)\n")
 
-        # Usar todas as imagens em loop para cobrir toda a duração do áudio
+        # Todas as imagens em sequência (concat demuxer) cobrindo a duração do áudio
         cmd = [
             "ffmpeg",
-            "-stream_loop", "-1",  # Loop infinito das imagens
-            "-r", f"{num_images/audio_duration}",  # Taxa para que as 5 imagens cubram todo o áudio
-            "-i", image_pattern,
+            "-f", "concat",
+            "-safe", "0",
+            "-i", str(concat_file),
             "-i", str(audio_file),
             "-vf", f"scale=1280:720:flags=lanczos",  # Apenas escalar para HD
-            "-c:v", "libopenh264",  # Encoder
-            "-crf", str(crf),
+            *h264_encoder_args(encoder, crf),  # Encoder (hardware, se disponível)
             "-c:a", "aac", 
             "-b:a", "128k",
-            "-pix_fmt", "yuv420p",
             "-t", str(audio_duration),  # Duração exata do áudio
+            "-map", "0:v:0",  # Vídeo das imagens
+            "-map", "1:a:0",  # Áudio da narração
+            "-movflags", "+faststart",  # moov no início: pronto para streaming, sem remux
+            "-threads", "0",
             "-y",  # Sobrescrever
             output_file
         ]
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+sd_daemon.py - Stable Diffusion residente (evita recarregar o modelo a cada execução)
+
+Carrega o pipeline uma única vez e atende pedidos de geração por um socket
+UNIX local. Com SD_DAEMON_SOCK definido, 05_generate_images.py envia as
+cenas para o daemon em vez de carregar o modelo. A etapa 5 do orchestrator.py
+(05_generate_images_lowmem.py) não usa o daemon.
+
+Uso:
+    python scripts/sd_daemon.py &
+    SD_DAEMON_SOCK="$XDG_RUNTIME_DIR/vidgen/sd.sock" \
+        python scripts/05_generate_images.py --output output/meu_video
+"""
+
+import argparse
+import importlib.util
+import os
+import secrets
+import stat
+import sys
+import tempfile
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from utils import logger
+
+
+def runtime_dir() -> Path:
+    """Diretório privado (0700) do socket e da chave: $XDG_RUNTIME_DIR/vidgen ou /tmp/vidgen-<uid>"""
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    path = Path(base) / "vidgen" if base else Path(tempfile.gettempdir()) / f"vidgen-{os.getuid()}"
+    path.mkdir(mode=0o700, exist_ok=True)
+
+    # Recusar diretório de outro usuário, link simbólico ou com permissão para terceiros
+    info = path.lstat()
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError(f"Diretório do daemon inseguro (esperado 0700 e do usuário atual): {path}")
+    return path
+
+
+def default_socket() -> str:
+    """Socket padrão do daemon, dentro do diretório privado"""
+    return str(runtime_dir() / "sd.sock")
+
+
+def load_authkey() -> bytes:
+    """Chave de autenticação: $SD_DAEMON_AUTHKEY ou chave aleatória em arquivo 0600
+
+    A conexão desserializa (pickle) as mensagens: só clientes e daemon com a
+    mesma chave secreta podem se falar.
+    """
+    env_key = os.environ.get("SD_DAEMON_AUTHKEY")
+    if env_key:
+        return env_key.encode()
+
+    key_dir = runtime_dir()
+    key_file = key_dir / "authkey"
+    if key_file.exists():
+        return key_file.read_bytes().strip()
+
+    # Chave completa em arquivo temporário (0600) e link atômico: um processo
+    # concorrente nunca lê o arquivo vazio; quem perder a corrida usa a chave do outro
+    fd, tmp_path = tempfile.mkstemp(dir=key_dir, prefix=".authkey-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(secrets.token_hex(32).encode())
+        try:
+            os.link(tmp_path, key_file)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(tmp_path)
+    return key_file.read_bytes().strip()
+
+
+class SDDaemonClient:
+    """Cliente do daemon (mesma interface de generate_batch do StableDiffusionGenerator)"""
+
+    def __init__(self, address: str, authkey: bytes = None):
+        self.address = address
+        self.conn = Client(address, family="AF_UNIX", authkey=authkey or load_authkey())
+        # O daemon se apresenta ao conectar: modo com que o modelo foi carregado
+        self.turbo = self.conn.recv().get("turbo", False)
+
+    def generate_batch(self, prompts: list[str], **kwargs) -> list[bytes]:
+        """Envia um lote de prompts e retorna as imagens PNG (bytes)"""
+        self.conn.send({"prompts": prompts, **kwargs})
+        reply = self.conn.recv()
+        if "error" in reply:
+            raise RuntimeError(f"Daemon: {reply['error']}")
+        return reply["images"]
+
+    def close(self):
+        """Encerra a conexão (o daemon continua rodando)"""
+        self.conn.close()
+
+
+def load_generator(turbo: bool = False):
+    """Instancia o StableDiffusionGenerator de 05_generate_images.py"""
+    script = Path(__file__).parent / "05_generate_images.py"
+    spec = importlib.util.spec_from_file_location("generate_images", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.StableDiffusionGenerator(turbo=turbo)
+
+
+def handle_connection(conn, sd):
+    """Atende um cliente: apresenta o modo do modelo e gera lotes até ele desconectar"""
+    conn.send({"turbo": sd.turbo})
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            prompts = job.pop("prompts")
+            logger.info(f"⏳ Lote de {len(prompts)} prompt(s)")
+            images = sd.generate_batch(prompts, **job)
+        except Exception as e:
+            conn.send({"error": str(e)})
+            continue
+        conn.send({"images": images})
+
+
+def serve(address: str, authkey: bytes = None, turbo: bool = False):
+    """Carrega o modelo e atende conexões (uma por vez: a GPU é uma só)"""
+    authkey = authkey or load_authkey()
+    sd = load_generator(turbo)
+    sd._init_pipeline()
+
+    # Socket de uma execução anterior que não foi encerrada
+    if os.path.lexists(address):
+        try:
+            os.unlink(address)
+        except OSError as e:
+            raise RuntimeError(f"Não foi possível remover o socket existente {address}: {e}") from e
+
+    listener = Listener(address, family="AF_UNIX", authkey=authkey)
+    logger.info(f"🟢 Daemon Stable Diffusion ouvindo em {address}{' (turbo)' if turbo else ''}")
+
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                logger.warning(f"Conexão recusada: {e}")
+                continue
+
+            # Cliente que caiu no meio (Ctrl-C, processo morto) não derruba o daemon
+            try:
+                with conn:
+                    handle_connection(conn, sd)
+            except (EOFError, OSError) as e:
+                logger.warning(f"Cliente desconectado: {e!r}")
+    except KeyboardInterrupt:
+        logger.info("Daemon encerrado")
+    finally:
+        listener.close()
+        if os.path.exists(address):
+            os.unlink(address)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stable Diffusion residente para a etapa 5"
+    )
+    parser.add_argument(
+        "--socket",
+        default=os.environ.get("SD_DAEMON_SOCK"),
+        help="Caminho do socket UNIX (padrão: $SD_DAEMON_SOCK ou $XDG_RUNTIME_DIR/vidgen/sd.sock)"
+    )
+
+    parser.add_argument(
+        "--turbo",
+        action="store_true",
+        help="Carrega o LCM-LoRA (para clientes com --turbo)"
+    )
+
+    args = parser.parse_args()
+    serve(args.socket or default_socket(), turbo=args.turbo)
+
+
+if __name__ == "__main__":
+    main()
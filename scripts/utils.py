@@ -2,15 +2,27 @@
 utils.py - Funções compartilhadas da pipeline de vídeos
 """
 
+import asyncio
+import functools
 import json
 import os
+import re
+import shutil
+import subprocess
 import sys
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterator, Optional
 import logging
+from dataclasses import dataclass, asdict, field, fields, MISSING
+
+try:
+    import orjson  # Serialização JSON nativa (opcional)
+except ImportError:
+    orjson = None
 
 # Setup logging
 logging.basicConfig(
@@ -20,6 +32,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Padrões do roteiro (compilados uma única vez)
+# Uma linha relevante do roteiro: cabeçalho de cena, narração ou visual
+_SCRIPT_LINE_RE = re.compile(
+    r'^.*?## CENA (?P<numero>\d+) \((?P<start>\d+)-(?P<end>\d+)s\)'
+    r'|^\*\*Narração:\*\*[ \t]*(?P<naracao>.*?)[ \t\r]*$'
+    r'|^\*\*Visual:\*\*[ \t]*(?P<visual>.*?)[ \t\r]*$',
+    re.MULTILINE
+)
+_NARR_RE = re.compile(r'^\*\*Narração:\*\*[ \t]*(.*?)[ \t\r]*$', re.MULTILINE)
+# Número no início de um valor do LLM ('60s', '5 cenas')
+_LEADING_INT_RE = re.compile(r'\s*(\d+)')
+# Timing de cena: '0-10s' ou '5s-10s' (os 's' são opcionais)
+_TIMING_RE = re.compile(r'\s*(\d+(?:\.\d+)?)\s*s?\s*-\s*(\d+(?:\.\d+)?)\s*s?')
+
 
 class OllamaClient:
     """Cliente para interagir com Ollama local"""
@@ -28,16 +54,39 @@ class OllamaClient:
         self.base_url = base_url
         self.api_endpoint = f"{base_url}/api/generate"
 
-    def generate(self, prompt: str, model: str = "mistral", temperature: float = 0.7) -> str:
-        """Gera texto usando modelo Ollama"""
+        # Sessão com keep-alive: reaproveita conexões entre as chamadas
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers.update({"Connection": "keep-alive"})
+
+    def close(self):
+        """Fecha as conexões do pool (a sessão reabre se for usada de novo)"""
+        self._session.close()
+
+    def __enter__(self) -> "OllamaClient":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def generate(
+        self,
+        prompt: str,
+        model: str = "mistral",
+        temperature: float = 0.7,
+        options: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """Gera texto usando modelo Ollama (options: num_predict, num_ctx, ...)"""
         try:
-            response = requests.post(
+            response = self._session.post(
                 self.api_endpoint,
                 json={
                     "model": model,
                     "prompt": prompt,
                     "stream": False,
-                    "temperature": temperature
+                    "options": {"temperature": temperature, **(options or {})}
                 },
                 timeout=300
             )
@@ -51,6 +100,30 @@ class OllamaClient:
             logger.error(f"Erro ao gerar com Ollama: {e}")
             raise
 
+    def warmup(self, model: str = "mistral", keep_alive: str = "10m"):
+        """Carrega o modelo na memória do Ollama (requisição sem prompt)"""
+        response = self._session.post(
+            self.api_endpoint,
+            json={
+                "model": model,
+                "prompt": "",
+                "keep_alive": keep_alive,
+                "stream": False
+            },
+            timeout=300
+        )
+        response.raise_for_status()
+
+    async def generate_async(
+        self,
+        prompt: str,
+        model: str = "mistral",
+        temperature: float = 0.7,
+        options: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """Versão assíncrona de generate (requisição roda em uma thread)"""
+        return await asyncio.to_thread(self.generate, prompt, model, temperature, options)
+
     def generate_json(self, prompt: str, model: str = "mistral") -> Dict[str, Any]:
         """Gera JSON usando Ollama"""
         response_text = self.generate(prompt, model)
@@ -61,6 +134,82 @@ class OllamaClient:
             raise
 
 
+def _lenient_int(value: Any, default: int) -> int:
+    """Inteiro de um campo do LLM (aceita '60s', '5 cenas'; senão o padrão)"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    match = _LEADING_INT_RE.match(str(value)) if value is not None else None
+    if match:
+        return int(match.group(1))
+    if value is not None:
+        logger.warning(f"Valor numérico inválido: {value!r}, usando {default}")
+    return default
+
+
+@dataclass
+class Plan:
+    """Estrutura de plan.json (validada uma única vez, compartilhada pelos steps)
+
+    Chaves extras da resposta do LLM ficam em extra e voltam no to_dict().
+    """
+
+    tema: str
+    publico: str
+    tom: str
+    pontos_chave: list[str]
+    num_cenas: int = 5
+    hook_inicial: str = ""
+    call_to_action: str = ""
+    duracao_segundos: int = 60
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], required: Optional[tuple] = None) -> "Plan":
+        """Valida e normaliza um plano (resposta do Ollama ou plan.json)
+
+        required: campos exigidos (padrão: todos sem valor padrão). Quem só usa
+        alguns campos (ex.: etapa 4, tema e tom) valida só esses.
+        """
+        if required is None:
+            required = tuple(
+                f.name for f in fields(cls)
+                if f.default is MISSING and f.default_factory is MISSING
+            )
+        missing = [name for name in required if name not in data]
+        if missing:
+            logger.error(f"Campo obrigatório faltando: {', '.join(missing)}")
+            raise ValueError(f"Plano inválido: falta {', '.join(missing)}")
+
+        pontos_chave = data.get("pontos_chave", [])
+        if not isinstance(pontos_chave, list):
+            pontos_chave = [pontos_chave]
+
+        known = {f.name for f in fields(cls)}
+        return cls(
+            tema=str(data.get("tema", "")),
+            publico=str(data.get("publico", "")),
+            tom=str(data.get("tom", "")),
+            pontos_chave=[str(ponto) for ponto in pontos_chave],
+            num_cenas=_lenient_int(data.get("num_cenas"), 5),
+            hook_inicial=str(data.get("hook_inicial", "")),
+            call_to_action=str(data.get("call_to_action", "")),
+            duracao_segundos=_lenient_int(data.get("duracao_segundos"), 60),
+            extra={key: value for key, value in data.items() if key not in known}
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Retorna o plano como dicionário (formato de plan.json, com as chaves extras)"""
+        data = asdict(self)
+        extra = data.pop("extra")
+        return {**data, **extra}
+
+
+@functools.lru_cache(maxsize=None)
+def get_ollama_client(base_url: str = "http://localhost:11434") -> OllamaClient:
+    """Retorna cliente Ollama compartilhado (uma sessão HTTP por URL)"""
+    return OllamaClient(base_url)
+
+
 class FileManager:
     """Gerencia estrutura de arquivos do projeto"""
 
@@ -79,16 +228,25 @@ class FileManager:
             dir_path.mkdir(parents=True, exist_ok=True)
 
     def save_json(self, filename: str, data: Dict[str, Any]):
-        """Salva JSON com indentação"""
+        """Salva JSON com indentação (orjson, se instalado)"""
         filepath = self.output_dir / filename
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        if orjson is not None:
+            # NON_STR_KEYS: chaves int/float viram string, como no json da stdlib
+            filepath.write_bytes(orjson.dumps(
+                data,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+            ))
+        else:
+            with open(filepath, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2, ensure_ascii=False)
         logger.info(f"✓ Salvo: {filename}")
         return filepath
 
     def load_json(self, filename: str) -> Dict[str, Any]:
-        """Carrega JSON"""
+        """Carrega JSON (orjson, se instalado)"""
         filepath = self.output_dir / filename
+        if orjson is not None:
+            return orjson.loads(filepath.read_bytes())
         with open(filepath, 'r', encoding='utf-8') as f:
             return json.load(f)
 
@@ -106,6 +264,12 @@ class FileManager:
         with open(filepath, 'r', encoding='utf-8') as f:
             return f.read()
 
+    def load_lines(self, filename: str) -> Iterator[str]:
+        """Itera as linhas de um arquivo de texto (o arquivo fecha ao fim da iteração)"""
+        filepath = self.output_dir / filename
+        with open(filepath, 'r', encoding='utf-8') as f:
+            yield from f
+
     def get_image_path(self, scene_num: int) -> Path:
         """Retorna caminho para imagem de cena"""
         return self.dirs["images"] / f"scene_{scene_num:03d}.png"
@@ -115,6 +279,17 @@ class FileManager:
         return self.dirs["audio"] / "narration.wav"
 
 
+# Loader YAML em C (LibYAML), se o PyYAML foi compilado com ela
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_yaml_cached(path: str, mtime: float) -> Dict[str, Any]:
+    """Parseia um YAML (cache por arquivo + mtime: relê só se o arquivo mudar)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return yaml.load(f, Loader=_YAML_LOADER) or {}
+
+
 class ConfigManager:
     """Gerencia configurações do projeto"""
 
@@ -130,8 +305,7 @@ class ConfigManager:
             logger.warning(f"Config não encontrado: {filename}")
             return {}
 
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return yaml.safe_load(f) or {}
+        return _load_yaml_cached(str(filepath), os.path.getmtime(filepath))
 
     def get_prompt(self, prompt_key: str) -> str:
         """Retorna template de prompt"""
@@ -149,49 +323,61 @@ class ScriptParser:
 
     @staticmethod
     def parse_script(script_content: str) -> list[Dict[str, Any]]:
-        """Parseia script markdown e extrai cenas"""
+        """Parseia script markdown e extrai cenas (timing, narração e visual)"""
         scenes = []
         current_scene = None
 
-        lines = script_content.split('\n')
-        for line in lines:
-            # Detectar cabeçalho de cena
-            if line.startswith('## CENA'):
-                if current_scene:
-                    scenes.append(current_scene)
-
-                # Extrair número da cena e timing
-                parts = line.split('(')
-                scene_num = int(''.join(filter(str.isdigit, parts[0].split()[-1])))
-                timing = parts[1].rstrip(')') if len(parts) > 1 else "0-10s"
-
+        for match in _SCRIPT_LINE_RE.finditer(script_content):
+            # Cabeçalho de cena (## CENA X (Y-Zs))
+            if match.group("numero") is not None:
+                start, end = match.group("start"), match.group("end")
                 current_scene = {
-                    "numero": scene_num,
-                    "timing": timing,
+                    "numero": int(match.group("numero")),
+                    "start": int(start),
+                    "end": int(end),
+                    "timing": f"{start}-{end}s",
                     "naracao": "",
                     "visual": ""
                 }
+                scenes.append(current_scene)
 
-            # Extrair narração
-            elif line.startswith('**Narração:**') and current_scene:
-                current_scene["naracao"] = line.replace('**Narração:**', '').strip()
+            elif current_scene is None:
+                continue
 
-            # Extrair visual
-            elif line.startswith('**Visual:**') and current_scene:
-                current_scene["visual"] = line.replace('**Visual:**', '').strip()
+            # Narração
+            elif match.group("naracao") is not None:
+                current_scene["naracao"] = match.group("naracao")
 
-        if current_scene:
-            scenes.append(current_scene)
+            # Visual
+            else:
+                current_scene["visual"] = match.group("visual")
 
         return scenes
 
 
+def extract_narration_text(script_content: str) -> str:
+    """Extrai todo o texto de narração do script (uma única varredura regex)"""
+    return ' '.join(_NARR_RE.findall(script_content))
+
+
 class TimestampExtractor:
     """Extrai timestamps de áudio"""
 
     @staticmethod
     def extract_from_audio(audio_path: str) -> Dict[str, Any]:
         """Extrai duração e calcula timestamps (aproximado)"""
+        # Só o cabeçalho do arquivo: sem decodificar o áudio inteiro
+        try:
+            import soundfile
+            info = soundfile.info(audio_path)
+            return {
+                "duration_seconds": info.frames / info.samplerate,
+                "sample_rate": info.samplerate,
+                "num_samples": info.frames
+            }
+        except Exception as e:
+            logger.debug(f"soundfile indisponível para {audio_path} ({e}), usando librosa")
+
         try:
             import librosa
             y, sr = librosa.load(audio_path, sr=None)
@@ -207,6 +393,75 @@ class TimestampExtractor:
             return {"duration_seconds": 0, "error": str(e)}
 
 
+# Encoders H.264: hardware em ordem de preferência, depois software
+_HW_H264_ENCODERS = ("h264_videotoolbox", "h264_nvenc", "h264_qsv")
+_SW_H264_ENCODERS = ("libx264", "libopenh264")
+
+
+def h264_encoder_args(codec: str, crf: int) -> list[str]:
+    """Argumentos FFmpeg do encoder, com a qualidade (CRF 0-51) no controle nativo dele"""
+    if codec == "h264_nvenc":
+        return ["-c:v", codec, "-preset", "p5", "-tune", "hq", "-rc", "vbr",
+                "-cq", str(crf), "-b:v", "0", "-pix_fmt", "yuv420p"]
+    if codec == "h264_videotoolbox":
+        # -q:v vai de 1 a 100 (maior = melhor): CRF 18 -> 64, CRF 23 -> 54
+        quality = max(1, min(100, 100 - 2 * crf))
+        return ["-c:v", codec, "-q:v", str(quality), "-pix_fmt", "yuv420p"]
+    if codec == "h264_qsv":
+        return ["-c:v", codec, "-preset", "medium", "-global_quality", str(crf),
+                "-pix_fmt", "nv12"]
+    if codec == "libx264":
+        # veryfast: sem hardware, a etapa 7 não pode ficar mais lenta que o
+        # libopenh264 de antes (no mesmo CRF, só o arquivo fica um pouco maior)
+        return ["-c:v", codec, "-preset", "veryfast", "-crf", str(crf), "-pix_fmt", "yuv420p"]
+    return ["-c:v", codec, "-crf", str(crf), "-pix_fmt", "yuv420p"]
+
+
+def _h264_encoder_works(codec: str) -> bool:
+    """Testa o encoder com um clipe mínimo (estar listado não garante hardware presente)"""
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-v", "error",
+             "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.1",
+             *h264_encoder_args(codec, 23), "-f", "null", "-"],
+            capture_output=True,
+            timeout=15
+        )
+        return result.returncode == 0
+    except (subprocess.TimeoutExpired, FileNotFoundError):
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def detect_h264_encoder() -> str:
+    """Retorna o encoder H.264 mais rápido disponível (hardware, senão libx264)"""
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            timeout=10
+        )
+    except (subprocess.TimeoutExpired, FileNotFoundError):
+        return "libx264"
+
+    available = {
+        parts[1] for parts in map(str.split, result.stdout.splitlines())
+        if len(parts) > 1
+    }
+
+    for codec in _HW_H264_ENCODERS:
+        if codec in available and _h264_encoder_works(codec):
+            logger.info(f"🚀 Encoder por hardware: {codec}")
+            return codec
+
+    for codec in _SW_H264_ENCODERS:
+        if codec in available:
+            return codec
+
+    return "libx264"
+
+
 class VideoComposer:
     """Ferramentas para composição de vídeo com FFmpeg"""
 
@@ -232,13 +487,15 @@ class VideoComposer:
         if subtitle_path and Path(subtitle_path).exists():
             cmd.extend(["-vf", f"subtitles={subtitle_path}"])
 
-        # Codec e qualidade
+        # Codec (hardware, se disponível) e qualidade
+        cmd.extend(h264_encoder_args(detect_h264_encoder(), crf))
         cmd.extend([
-            "-c:v", "libx264",
-            "-preset", "slow",
-            "-crf", str(crf),
             "-c:a", "aac",
             "-b:a", "128k",
+            "-map", "0:v:0",
+            "-map", "1:a:0",
+            "-movflags", "+faststart",
+            "-threads", "0",
             "-y",  # Overwrite output
             output_path
         ])
@@ -246,6 +503,67 @@ class VideoComposer:
         return " ".join(cmd)
 
 
+# LCM-LoRA para SD 1.5: 4 steps sem CFG no lugar de 15-25 steps
+LCM_LORA_ID = "latent-consistency/lcm-lora-sdv1-5"
+TURBO_STEPS = 4
+TURBO_GUIDANCE = 1.0  # <= 1 desativa o CFG (uma passada de UNet por step, não duas)
+
+
+def enable_lcm_lora(pipe):
+    """Funde o LCM-LoRA na UNet e troca o scheduler pelo LCMScheduler (modo turbo)"""
+    from diffusers import LCMScheduler
+
+    logger.info(f"   ⚡ Modo turbo: LCM-LoRA ({LCM_LORA_ID}, {TURBO_STEPS} steps)")
+    pipe.load_lora_weights(LCM_LORA_ID)
+    pipe.fuse_lora()
+    pipe.unload_lora_weights()  # Pesos já fundidos: remove as camadas LoRA extras
+    pipe.scheduler = LCMScheduler.from_config(pipe.scheduler.config)
+
+
+def optimize_sd_pipeline(
+    pipe,
+    compile_mode: Optional[str] = "reduce-overhead",
+    warmup_size: tuple[int, int] = (512, 512),
+    guidance_scale: float = 7.5
+):
+    """Atenção fused (xformers/SDPA) e torch.compile na UNet do Stable Diffusion
+
+    compile_mode=None desativa o torch.compile. Com cpu_offload ativo use
+    "default": os CUDA graphs de "reduce-overhead" não suportam pesos que
+    entram e saem da GPU a cada chamada.
+    """
+    import importlib.util
+    import torch
+
+    # Atenção fused: mesma conta, bem menos leitura/escrita na memória da GPU
+    if importlib.util.find_spec("xformers") is not None:
+        pipe.enable_xformers_memory_efficient_attention()
+        logger.info("   Atenção: xformers")
+    else:
+        from diffusers.models.attention_processor import AttnProcessor2_0
+        pipe.unet.set_attn_processor(AttnProcessor2_0())
+        logger.info("   Atenção: SDPA (PyTorch 2)")
+
+    if not compile_mode or not torch.cuda.is_available():
+        return
+
+    pipe.unet = torch.compile(pipe.unet, mode=compile_mode, fullgraph=False)
+
+    # Compilar agora (inferência descartável no tamanho real) e não na primeira cena
+    logger.info(f"   ⏳ Compilando UNet (torch.compile, mode={compile_mode})...")
+    height, width = warmup_size
+    with torch.no_grad():
+        pipe(
+            prompt="warmup",
+            height=height,
+            width=width,
+            num_inference_steps=2,
+            guidance_scale=guidance_scale,
+            output_type="latent"
+        )
+    logger.info("   ✓ UNet compilada")
+
+
 def validate_dependencies():
     """Valida se todas as dependências estão instaladas"""
 
@@ -269,26 +587,63 @@ def validate_dependencies():
     return True
 
 
+@functools.lru_cache(maxsize=1)
+def _path_executables() -> frozenset[str]:
+    """Executáveis do $PATH (uma varredura por processo, em vez de um which por comando)"""
+    found = set()
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        try:
+            with os.scandir(directory or ".") as entries:
+                found.update(
+                    entry.name for entry in entries
+                    if entry.is_file() and os.access(entry.path, os.X_OK)
+                )
+        except OSError:
+            continue
+    return frozenset(found)
+
+
 def _command_exists(command: str) -> bool:
-    """Verifica se comando está disponível"""
-    from shutil import which
-    return which(command) is not None
+    """Verifica se comando está disponível (caminhos explícitos ainda usam which)"""
+    if os.sep in command:
+        return shutil.which(command) is not None
+    return command in _path_executables()
+
+
+@functools.lru_cache(maxsize=4096)
+def format_hms(total_secs: int) -> str:
+    """Segundos inteiros em "HH:MM:SS" (em cache: linhas seguidas caem no mesmo segundo)"""
+    minutes, secs = divmod(total_secs, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+
+
+def split_timestamp(seconds: float) -> tuple[str, int]:
+    """Divide segundos em "HH:MM:SS" e milissegundos (base de SRT e VTT)
+
+    Os ms vêm de int(seconds * 1000), não de (seconds % 1) * 1000: 7.1s vira
+    ",100" (antes ",099", erro de ponto flutuante do módulo).
+    """
+    total_secs, millis = divmod(int(seconds * 1000), 1000)
+    return format_hms(total_secs), millis
 
 
 def timestamp_to_srt_time(seconds: float) -> str:
     """Converte segundos para formato SRT (HH:MM:SS,mmm)"""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
-    millis = int((seconds % 1) * 1000)
-    return f"{hours:02d}:{minutes:02d}:{secs:02d},{millis:03d}"
+    hms, millis = split_timestamp(seconds)
+    return f"{hms},{millis:03d}"
+
+
+def timestamp_to_vtt_time(seconds: float) -> str:
+    """Converte segundos para formato VTT (HH:MM:SS.mmm)"""
+    hms, millis = split_timestamp(seconds)
+    return f"{hms}.{millis:03d}"
 
 
 def extract_timing(timing_str: str) -> tuple[float, float]:
     """Extrai start e end de string como '0-10s'"""
-    try:
-        parts = timing_str.replace('s', '').split('-')
-        return float(parts[0]), float(parts[1])
-    except (ValueError, IndexError):
-        logger.warning(f"Timing inválido: {timing_str}, usando 0-10")
-        return 0.0, 10.0
+    match = _TIMING_RE.match(timing_str)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    logger.warning(f"Timing inválido: {timing_str}, usando 0-10")
+    return 0.0, 10.0